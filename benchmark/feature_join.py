@@ -0,0 +1,60 @@
+# Benchmark of heat feature join, run from repository root:
+#     python -m benchmark.feature_join
+import sys
+
+from loguru import logger
+
+from utils import csvIO
+from preprocessor import data_integrator, sales_feature
+from predictor import kMeans
+from benchmark.monthly_sales import measure
+
+
+def main():
+    logger.info("Reading dataset, file name: ./dataset/sales_train.csv")
+    sales_train = csvIO.read_sales_train(
+        "./dataset/sales_train.csv",
+        ["date_block_num", "shop_id", "item_id", "item_price", "item_cnt_day"],
+    )
+    item_idx = csvIO.read_csv_with_schema(
+        "./dataset/items.csv",
+        ["item_id", "item_category_id"],
+    )
+
+    # Build monthly sales and heat tables as trainer does, heat by batched engine for speed
+    monthly_sales = data_integrator.join_category_info(
+        data_integrator.integrate_monthly_sales(sales_train),
+        item_idx,
+    )[['date_block_num', 'shop_id', 'item_id', 'item_category_id',
+       'avg_sales_price', 'total_sales', 'total_record_count']]
+    stat_dict = sales_feature.grouped_statistics(
+        monthly_sales,
+        sales_feature.SALES_STATISTIC_SPECS,
+    )
+    heat_list = [
+        kMeans.extract_sales_heat(stat_dict[sales_feature.CAT_SHOP_SALES_SPEC.prefix], engine="lloyd"),
+        kMeans.extract_monthly_item_sales_heat(stat_dict[sales_feature.MONTHLY_ITEM_SALES_SPEC.prefix], engine="lloyd"),
+        kMeans.extract_monthly_item_cat_sales_heat(stat_dict[sales_feature.MONTHLY_ITEM_CAT_SALES_SPEC.prefix], engine="lloyd"),
+    ]
+
+    # Disable debug message during measurement
+    logger.remove()
+    join_data_merge, elapsed_merge = measure(
+        lambda: data_integrator.feature_join(monthly_sales, *heat_list, engine="merge"),
+    )
+    join_data_index, elapsed_index = measure(
+        lambda: data_integrator.feature_join(monthly_sales, *heat_list, engine="index"),
+    )
+    logger.add(sys.stderr)
+
+    # Output must be identical, including column order and dtype
+    assert list(join_data_merge.columns) == list(join_data_index.columns), "Inconsistant output columns"
+    assert join_data_merge.equals(join_data_index), "Inconsistant output value"
+
+    logger.info(f"Input rows: {len(monthly_sales)}, output shape: {join_data_index.shape}")
+    logger.info(f"  merge: {elapsed_merge:.3f} s")
+    logger.info(f"  index: {elapsed_index:.3f} s ({elapsed_merge / elapsed_index:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
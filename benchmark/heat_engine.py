@@ -0,0 +1,64 @@
+# Benchmark of sales heat clustering engines, run from repository root:
+#     python -m benchmark.heat_engine
+import sys
+
+import numpy as np
+from loguru import logger
+
+from utils import csvIO
+from preprocessor import data_integrator, sales_feature
+from predictor import kMeans
+from benchmark.monthly_sales import measure
+
+
+def main():
+    logger.info("Reading dataset, file name: ./dataset/sales_train.csv")
+    sales_train = csvIO.read_sales_train(
+        "./dataset/sales_train.csv",
+        ["date_block_num", "shop_id", "item_id", "item_price", "item_cnt_day"],
+    )
+    item_idx = csvIO.read_csv_with_schema(
+        "./dataset/items.csv",
+        ["item_id", "item_category_id"],
+    )
+
+    # Build the same shop/month and monthly partitions as trainer
+    monthly_sales = data_integrator.join_category_info(
+        data_integrator.integrate_monthly_sales(sales_train),
+        item_idx,
+    )
+    stat_dict = sales_feature.grouped_statistics(
+        monthly_sales,
+        sales_feature.SALES_STATISTIC_SPECS,
+    )
+
+    extractor_list = [
+        (kMeans.extract_sales_heat, sales_feature.CAT_SHOP_SALES_SPEC.prefix, "cat_shop_sales_heat"),
+        (kMeans.extract_monthly_item_sales_heat, sales_feature.MONTHLY_ITEM_SALES_SPEC.prefix, "monthly_total_item_sales_heat"),
+        (kMeans.extract_monthly_item_cat_sales_heat, sales_feature.MONTHLY_ITEM_CAT_SALES_SPEC.prefix, "monthly_total_item_cat_sales_heat"),
+    ]
+
+    for extractor, prefix, heat_column in extractor_list:
+        # Disable debug message during measurement
+        logger.remove()
+        heat_sklearn, elapsed_sklearn = measure(
+            lambda: extractor(stat_dict[prefix], engine="sklearn"),
+            repeat=1,
+        )
+        engine_result = {}
+        for engine in ["dp", "lloyd"]:
+            engine_result[engine] = measure(
+                lambda: extractor(stat_dict[prefix], engine=engine),
+            )
+        logger.add(sys.stderr)
+
+        logger.info(f"{extractor.__name__}, rows: {len(heat_sklearn)}")
+        logger.info(f"  sklearn: {elapsed_sklearn:.3f} s")
+        for engine, (heat_data, elapsed) in engine_result.items():
+            assert heat_sklearn.index.equals(heat_data.index), "Inconsistant output index"
+            agreement = np.mean(heat_sklearn[heat_column].to_numpy() == heat_data[heat_column].to_numpy())
+            logger.info(f"  {engine}: {elapsed:.3f} s ({elapsed_sklearn / elapsed:.2f}x), label agreement: {agreement:.4f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Benchmark of monthly sales aggregation, run from repository root:
+#     python -m benchmark.monthly_sales
+import sys
+import time
+
+import numpy as np
+from loguru import logger
+
+from utils import csvIO
+from preprocessor import data_integrator
+
+
+def measure(func, *args, repeat: int = 3):
+    elapsed_list = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = func(*args)
+        elapsed_list.append(time.perf_counter() - start_time)
+    return output, min(elapsed_list)
+
+
+def main():
+    logger.info("Reading dataset, file name: ./dataset/sales_train.csv")
+    sales_train = csvIO.read_sales_train(
+        "./dataset/sales_train.csv",
+        ["date_block_num", "shop_id", "item_id", "item_price", "item_cnt_day"],
+    )
+
+    # Disable debug message during measurement
+    logger.remove()
+    agg_sales_old, elapsed_old = measure(
+        lambda: data_integrator.integrate_monthly_sales_old(sales_train.copy())
+    )
+    agg_sales, elapsed_new = measure(
+        lambda: data_integrator.integrate_monthly_sales(sales_train)
+    )
+    logger.add(sys.stderr)
+
+    # Check consistency of both implementation
+    assert list(agg_sales_old.columns) == list(agg_sales.columns), "Inconsistant output columns"
+    assert len(agg_sales_old) == len(agg_sales), "Inconsistant output length"
+    for col in agg_sales.columns:
+        assert np.allclose(agg_sales_old[col].to_numpy(), agg_sales[col].to_numpy(), rtol=1e-5), f"Inconsistant column: {col}"
+
+    logger.info(f"Record count: {len(sales_train)}, output length: {len(agg_sales)}")
+    logger.info(f"integrate_monthly_sales_old: {elapsed_old:.3f} s")
+    logger.info(f"integrate_monthly_sales: {elapsed_new:.3f} s ({elapsed_old / elapsed_new:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Benchmark of time series lag encoding, run from repository root:
+#     python -m benchmark.ts_encoding
+import sys
+
+from loguru import logger
+
+from utils import csvIO
+from preprocessor import data_integrator, data_normalizer, sales_feature
+from predictor import kMeans
+from benchmark.monthly_sales import measure
+
+
+def main():
+    logger.info("Reading dataset, file name: ./dataset/sales_train.csv")
+    sales_train = csvIO.read_sales_train(
+        "./dataset/sales_train.csv",
+        ["date_block_num", "shop_id", "item_id", "item_price", "item_cnt_day"],
+    )
+    item_idx = csvIO.read_csv_with_schema(
+        "./dataset/items.csv",
+        ["item_id", "item_category_id"],
+    )
+
+    # Build normalized input of lag encoding as trainer does, heat by batched engine for speed
+    monthly_sales = data_integrator.join_category_info(
+        data_integrator.integrate_monthly_sales(sales_train),
+        item_idx,
+    )[['date_block_num', 'shop_id', 'item_id', 'item_category_id',
+       'avg_sales_price', 'total_sales', 'total_record_count']]
+    stat_dict = sales_feature.grouped_statistics(
+        monthly_sales,
+        sales_feature.SALES_STATISTIC_SPECS,
+    )
+    train_data_with_feature = data_integrator.feature_join(
+        monthly_sales,
+        kMeans.extract_sales_heat(stat_dict[sales_feature.CAT_SHOP_SALES_SPEC.prefix], engine="lloyd"),
+        kMeans.extract_monthly_item_sales_heat(stat_dict[sales_feature.MONTHLY_ITEM_SALES_SPEC.prefix], engine="lloyd"),
+        kMeans.extract_monthly_item_cat_sales_heat(stat_dict[sales_feature.MONTHLY_ITEM_CAT_SALES_SPEC.prefix], engine="lloyd"),
+    )
+    train_data_with_feature.drop(
+        columns=[col for col in train_data_with_feature.columns if col.endswith(("_sum", "_mean"))] + ['total_record_count'],
+        inplace=True,
+    )
+    norm_train_data = data_normalizer.train_norm(train_data_with_feature)
+    norm_train_data["date_block_num"] = train_data_with_feature["date_block_num"]
+    norm_train_data["total_sales"] = train_data_with_feature["total_sales"]
+
+    for month_count in [12, 24, 36]:
+        # Disable debug message during measurement
+        logger.remove()
+        ts_data_old, elapsed_old = measure(
+            lambda: data_integrator.encode_time_series_data_old(norm_train_data, month_count),
+            repeat=1,
+        )
+        ts_data, elapsed_new = measure(
+            lambda: data_integrator.encode_time_series_data(norm_train_data, month_count),
+        )
+        logger.add(sys.stderr)
+
+        # Output must be identical, including column order and dtype, empty output follows lag spec
+        if len(ts_data_old) == 0:
+            lag_spec = data_integrator.LagSpec.legacy(
+                [col for col in norm_train_data.columns if col not in data_integrator._TS_KEY_COLUMNS],
+                month_count,
+            )
+            assert len(ts_data) == 0, "Inconsistant output rows"
+            assert list(ts_data.columns) == list(norm_train_data.columns) + lag_spec.columns(list(norm_train_data.columns)), "Inconsistant output columns"
+        else:
+            assert list(ts_data_old.columns) == list(ts_data.columns), "Inconsistant output columns"
+            assert ts_data_old.equals(ts_data), "Inconsistant output value"
+
+        logger.info(f"Lags: {month_count}, input rows: {len(norm_train_data)}, output shape: {ts_data.shape}")
+        logger.info(f"  encode_time_series_data_old: {elapsed_old:.3f} s")
+        logger.info(f"  encode_time_series_data: {elapsed_new:.3f} s ({elapsed_old / elapsed_new:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import os
+
 from loguru import logger
 import numpy as np
 import pandas as pd
@@ -9,8 +11,10 @@ from preprocessor import (
     data_integrator,
     data_cleaner,
     data_normalizer,
+    temporal_feature,
+    feature_store,
 )
-from predictor import DTR, XGBoost
+from predictor import DTR, XGBoost, kMeans
 
 def main_old():
     # load testing csv file
@@ -52,30 +56,35 @@ def main_old():
     csvIO.write_pd_to_csv(opres, "submission.csv", False)
 
 
-def main():
+def main_from_history():
 #-----------------------------------------------------------------------------------
 # Phase 1. Read All Necessary File and Model
 
     logger.info("Load Files")
     # Load testing csv file
-    inference_data = csvIO.read_csv_to_pddf("./dataset/test.csv")
+    inference_data = csvIO.read_csv_with_schema("./dataset/test.csv")
 
     # Load sales information file
-    sales_information = csvIO.read_csv_to_pddf("./dataset/sales_train.csv")
+    # Normalization of inference is fitted on whole history, so read all months
+    sales_information = csvIO.read_sales_train(
+        "./dataset/sales_train.csv",
+        ["date_block_num", "shop_id", "item_id", "item_price", "item_cnt_day"],
+    )
 
     # Query category number (0 ~ 83) of an item by index
-    item_idx = csvIO.read_csv_to_pddf("./dataset/items.csv")
-
-    # Load category heat value info
-    category_heat_value = csvIO.read_csv_to_pddf("./output/category_heat_value.csv")
-
-    # Load category heat value info
-    monthly_item_heat_value = csvIO.read_csv_to_pddf("./output/monthly_item_heat_value.csv")
+    item_idx = csvIO.read_csv_with_schema(
+        "./dataset/items.csv",
+        ["item_id", "item_category_id"],
+    )
 
-    monthly_item_cat_heat_value = csvIO.read_csv_to_pddf("./output/monthly_item_cat_heat_value.csv")
+    # Load heat thresholds, heat tables are rebuilt from sales history
+    heat_threshold = {
+        heat_name: csvIO.read_csv_to_pddf(f"./output/{heat_name}_heat_threshold.csv")
+        for heat_name in kMeans.HEAT_THRESHOLD_SPECS
+    }
 
     # Load XBGRegressor
-    xgbr = modelIO.load("./output/xgbr_new_feature.model")
+    xgbr, xgbr_meta = modelIO.load_booster("./output/xgbr_new_feature")
 
 #-----------------------------------------------------------------------------------
 # Phase 2. Generate Statistic Info and Join Necessary Information
@@ -95,6 +104,28 @@ def main():
          'avg_sales_price', 'total_sales',  'total_record_count']
     ]
 
+    # Sales Info - Label sales heat of statistics with thresholds
+    logger.info("Label sales heat with heat thresholds")
+    sales_statistic = sales_feature.grouped_statistics(
+        stat_sales_data_with_cat,
+        sales_feature.SALES_STATISTIC_SPECS,
+    )
+    category_heat_value = kMeans.label_heat_table(
+        sales_statistic[sales_feature.CAT_SHOP_SALES_SPEC.prefix],
+        heat_threshold["cat_shop"],
+        "cat_shop",
+    )
+    monthly_item_heat_value = kMeans.label_heat_table(
+        sales_statistic[sales_feature.MONTHLY_ITEM_SALES_SPEC.prefix],
+        heat_threshold["monthly_item"],
+        "monthly_item",
+    )
+    monthly_item_cat_heat_value = kMeans.label_heat_table(
+        sales_statistic[sales_feature.MONTHLY_ITEM_CAT_SALES_SPEC.prefix],
+        heat_threshold["monthly_item_cat"],
+        "monthly_item_cat",
+    )
+
     # Sales Info - Join With Sales Heat
     logger.info("Join data statistics with sales heat")
     stat_sales_info_with_feature = data_integrator.feature_join(
@@ -130,6 +161,7 @@ def main():
     # logger.info("Do Statistical Data Normalization")
     stat_sales_info_norm = data_normalizer.train_norm(stat_sales_info_with_feature)
     stat_sales_info_norm["date_block_num"] = stat_sales_info_with_feature["date_block_num"]
+    stat_sales_info_norm["total_sales"] = stat_sales_info_with_feature["total_sales"]
     # stat_sales_info_norm = stat_sales_info_with_feature
 
     # logger.info("Do Inference Data Normalization")
@@ -141,13 +173,18 @@ def main():
 # Phase 3. Encode Time Series Data For Inference
 
     logger.info("Encode Time Series Data for inference")
-    inference_ts_data = (
-        data_integrator.make_inference_ts_data(
-            inference_data_norm,
-            stat_sales_info_norm,
-            24,
-        )
+    lag_spec = data_integrator.LagSpec.from_dict(xgbr_meta["lag_spec"])
+
+    # History is looked up by original ids, normalized ids are model input only
+    key_columns = ["shop_id", "item_id", "item_category_id"]
+    history_data = stat_sales_info_norm.copy()
+    history_data[key_columns] = stat_sales_info_with_feature[key_columns].to_numpy()
+    inference_ts_data = data_integrator.encode_inference_ts_data(
+        inference_data_with_cat,
+        history_data,
+        lag_spec,
     )
+    inference_ts_data[key_columns] = inference_data_norm[key_columns].to_numpy()
 
     # Do normalization for month ID
     inference_ts_data["date_block_num"] = inference_ts_data["date_block_num"].apply(
@@ -162,6 +199,20 @@ def main():
         ],
         inplace=True,
     )
+    # Append temporal statistics if model is trained with them, rows keep order of test data
+    if xgbr_meta.get("temporal_feature") is not None:
+        logger.info("Evaluate rolling-window and EWMA statistics of past sales")
+        temporal_data = temporal_feature.rolling_feature(
+            stat_sales_data_with_cat,
+            inference_data_with_cat.assign(date_block_num=34),
+            windows=xgbr_meta["temporal_feature"]["windows"],
+            alphas=xgbr_meta["temporal_feature"]["alphas"],
+        )
+        inference_ts_data = pd.concat(
+            [inference_ts_data, temporal_data.reset_index(drop=True)],
+            axis=1,
+        )
+
     # inference_ts_data["total_sales"] = inference_data_with_cat["total_sales"]
     print(len(inference_ts_data.columns))
     print(inference_ts_data.columns)
@@ -182,5 +233,73 @@ def main():
     print(opres)
     csvIO.write_pd_to_csv(opres, "submission.csv", False)
 
+def main():
+    """Predict sales of 2015-11 from lag feature store, or from sales history if store can not serve the model
+
+    Store is used only if it is saved with the same training data hash and
+    lag spec as the model, and the model has no temporal statistics. The
+    two paths may give different predictions: the store keeps heat and
+    key normalization of training data, while history path re-labels heat
+    by thresholds and refits normalization on whole history and test data.
+    """
+    # Sales history is rebuilt only if lag feature store is absent or does not match model
+    if not os.path.isdir(feature_store.DEFAULT_STORE_DIR):
+        logger.info("Lag feature store not found, encode inference data from sales history")
+        return main_from_history()
+
+#-----------------------------------------------------------------------------------
+# Phase 1. Read Request, Lag Feature Store and Model
+
+    logger.info("Load Files")
+    inference_data = csvIO.read_csv_with_schema("./dataset/test.csv")
+    item_idx = csvIO.read_csv_with_schema(
+        "./dataset/items.csv",
+        ["item_id", "item_category_id"],
+    )
+    lag_feature_store = feature_store.LagFeatureStore.load(feature_store.DEFAULT_STORE_DIR)
+    xgbr, xgbr_meta = modelIO.load_booster("./output/xgbr_new_feature")
+
+    if xgbr_meta.get("temporal_feature") is not None:
+        logger.info("Model is trained with temporal statistics, encode inference data from sales history")
+        return main_from_history()
+    if (
+        lag_feature_store.train_data_hash is None
+        or lag_feature_store.train_data_hash != xgbr_meta.get("train_data_hash")
+        or lag_feature_store.lag_spec != data_integrator.LagSpec.from_dict(xgbr_meta["lag_spec"])
+    ):
+        logger.warning("Lag feature store does not match model, encode inference data from sales history")
+        return main_from_history()
+    logger.info(f"Encode inference data from lag feature store: {feature_store.DEFAULT_STORE_DIR}")
+
+#-----------------------------------------------------------------------------------
+# Phase 2. Gather Lagged Columns and Normalize Keys
+
+    logger.info("Gather lagged columns from lag feature store")
+    inference_data_with_cat = inference_data.join(item_idx["item_category_id"], on="item_id")
+    inference_ts_data = data_integrator.make_inference_ts_data(
+        inference_data_with_cat,
+        lag_feature_store,
+    )
+
+    # Keys are scaled by min/max of training data
+    key_columns = feature_store.KEY_COLUMNS
+    inference_ts_data[key_columns] = lag_feature_store.normalize_key(inference_ts_data).to_numpy()
+    inference_ts_data["date_block_num"] = inference_ts_data["date_block_num"].apply(
+        lambda x: (x % 12) - 0 / 11
+    )
+    inference_ts_data.drop(columns=["ID"], inplace=True)
+
+#-----------------------------------------------------------------------------------
+# Phase 3. Do XGBoost Inference and Output Result
+
+    logger.info("Do XGBoost Inference")
+    result = XGBoost.inference(xgbr, inference_ts_data)
+
+    opres = pd.DataFrame(result, columns=["item_cnt_month"]).reset_index().rename(columns={"index": "ID"})
+    opres.loc[opres["item_cnt_month"] < 0,"item_cnt_month"] = 0
+
+    print(opres)
+    csvIO.write_pd_to_csv(opres, "submission.csv", False)
+
 if __name__ == "__main__":
     main()
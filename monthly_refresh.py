@@ -0,0 +1,133 @@
+import argparse
+
+from loguru import logger
+import pandas as pd
+
+from utils import csvIO
+from preprocessor import data_integrator, sales_feature
+from predictor import kMeans
+from trainer import KMEANS_ENGINE, KMEANS_N_JOBS, KMEANS_RANDOM_STATE
+
+
+def main(new_month_filename: str):
+
+#-----------------------------------------------------------------------------------
+# Phase 1. Read Persisted Monthly Tables and Raw Sales of New Month
+
+    logger.info("Load monthly tables persisted by trainer")
+    agg_sales_data = csvIO.read_pickle_to_pddf("./output/monthly_sales.pkl")
+    category_sales_on_shop_per_month = csvIO.read_pickle_to_pddf("./output/cat_shop_monthly_sales.pkl")
+    monthly_total_item_sales = csvIO.read_pickle_to_pddf("./output/monthly_item_sales.pkl")
+    monthly_total_item_cat_sales = csvIO.read_pickle_to_pddf("./output/monthly_item_cat_sales.pkl")
+    category_heat_value = csvIO.read_csv_to_pddf("./output/category_heat_value.csv")
+    monthly_item_heat_value = csvIO.read_csv_to_pddf("./output/monthly_item_heat_value.csv")
+    monthly_item_cat_heat_value = csvIO.read_csv_to_pddf("./output/monthly_item_cat_heat_value.csv")
+
+    logger.info(f"Reading new month sales, file name: {new_month_filename}")
+    new_month_data = csvIO.read_csv_with_schema(
+        new_month_filename,
+        ["date_block_num", "shop_id", "item_id", "item_price", "item_cnt_day"],
+        schema_name="sales_train.csv",
+    )
+    item_info = csvIO.read_csv_with_schema(
+        "./dataset/items.csv",
+        ["item_id", "item_category_id"],
+    )
+
+#-----------------------------------------------------------------------------------
+# Phase 2. Append New Month to Monthly Sales and Statistics
+
+    logger.info("Append new month to monthly sales")
+    agg_sales_data = data_integrator.append_monthly_sales(
+        agg_sales_data,
+        new_month_data,
+        item_info,
+    )
+    new_month_sales = agg_sales_data.loc[
+        agg_sales_data["date_block_num"].isin(new_month_data["date_block_num"].unique())
+    ]
+
+    logger.info("Append new month to sales statistics")
+    category_sales_on_shop_per_month = sales_feature.append_month_statistic(
+        category_sales_on_shop_per_month,
+        new_month_sales,
+        sales_feature.shop_seasonal_sales_of_category,
+    )
+    monthly_total_item_sales = sales_feature.append_month_statistic(
+        monthly_total_item_sales,
+        new_month_sales,
+        sales_feature.item_total_sales,
+    )
+    monthly_total_item_cat_sales = sales_feature.append_month_statistic(
+        monthly_total_item_cat_sales,
+        new_month_sales,
+        sales_feature.item_category_total_sales,
+    )
+
+#-----------------------------------------------------------------------------------
+# Phase 3. Cluster Sales Heat of New Month Only
+
+    # Shop heat is clustered per (shop, month), so only partitions of new month are fitted
+    # Engine and seed are the same as trainer, labels of new month match a full retrain
+    logger.info("Cluster sales heat of new month")
+    new_month_list = sorted(new_month_sales["date_block_num"].unique())
+    category_heat_value = pd.concat(
+        [
+            category_heat_value,
+            kMeans.extract_sales_heat(
+                category_sales_on_shop_per_month.loc[
+                    category_sales_on_shop_per_month["date_block_num"].isin(new_month_list)
+                ],
+                n_jobs=KMEANS_N_JOBS,
+                random_state=KMEANS_RANDOM_STATE,
+                engine=KMEANS_ENGINE,
+            )[category_heat_value.columns],
+        ],
+        ignore_index=True,
+    )
+
+    # Monthly heat of new month is warm-started from centroids of the last stored month
+    monthly_item_heat_value = kMeans.append_monthly_heat(
+        monthly_item_heat_value,
+        monthly_total_item_sales.loc[monthly_total_item_sales["date_block_num"].isin(new_month_list)],
+        "monthly_item",
+        random_state=KMEANS_RANDOM_STATE,
+    )
+    monthly_item_cat_heat_value = kMeans.append_monthly_heat(
+        monthly_item_cat_heat_value,
+        monthly_total_item_cat_sales.loc[monthly_total_item_cat_sales["date_block_num"].isin(new_month_list)],
+        "monthly_item_cat",
+        random_state=KMEANS_RANDOM_STATE,
+    )
+
+#-----------------------------------------------------------------------------------
+# Phase 4. Persist Updated Tables
+
+    csvIO.write_pd_to_pickle(agg_sales_data, "monthly_sales.pkl", background=True)
+    csvIO.write_pd_to_pickle(category_sales_on_shop_per_month, "cat_shop_monthly_sales.pkl", background=True)
+    csvIO.write_pd_to_pickle(monthly_total_item_sales, "monthly_item_sales.pkl", background=True)
+    csvIO.write_pd_to_pickle(monthly_total_item_cat_sales, "monthly_item_cat_sales.pkl", background=True)
+    for heat_name, heat_value, heat_filename in [
+        ("cat_shop", category_heat_value, "category_heat_value.csv"),
+        ("monthly_item", monthly_item_heat_value, "monthly_item_heat_value.csv"),
+        ("monthly_item_cat", monthly_item_cat_heat_value, "monthly_item_cat_heat_value.csv"),
+    ]:
+        csvIO.write_pd_to_csv(heat_value, heat_filename, False, background=True)
+        csvIO.write_pd_to_csv(
+            kMeans.heat_threshold_table(heat_value, heat_name),
+            f"{heat_name}_heat_threshold.csv",
+            False,
+            background=True,
+        )
+    csvIO.flush_writer()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append raw sales of a new month to persisted monthly tables")
+    parser.add_argument(
+        "new_month_filename",
+        help="raw daily sales of new month, same schema as ./dataset/sales_train.csv",
+    )
+    args = parser.parse_args()
+
+    main(args.new_month_filename)
@@ -1,5 +1,8 @@
+import os
+
 import numpy as np
 import pandas as pd
+import xgboost as xgb
 from xgboost.sklearn import XGBRegressor
 from sklearn.preprocessing import MinMaxScaler
 from sklearn.pipeline import Pipeline
@@ -174,6 +177,133 @@ def train(
     return xgbr
 
 
+# Columns of encoded training data which are not model input
+_NON_FEATURE_COLUMNS = [
+    'avg_sales_price',
+    'total_sales',
+    'cat_shop_sales_heat',
+    'monthly_total_item_sales_heat',
+    'monthly_total_item_cat_sales_heat',
+]
+
+
+class ShardIter(xgb.DataIter):
+    """Feed shards of encoded training data to XGBoost one at a time
+
+    Rows of a shard are assigned to testing set by a generator seeded with
+    (random_state, shard key), so training and testing iterators over the
+    same shards split them the same way.
+    """
+
+    def __init__(
+        self,
+        shard_reader,
+        test_ratio: float,
+        is_test: bool,
+        random_state: int = 0,
+        cache_prefix: str = None,
+    ):
+        self.shard_reader = shard_reader
+        self.feature_columns = [col for col in shard_reader.columns if col not in _NON_FEATURE_COLUMNS]
+        self.test_ratio = test_ratio
+        self.is_test = is_test
+        self.random_state = random_state
+        self._it = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data) -> int:
+        if self._it == len(self.shard_reader):
+            return 0
+
+        shard_key = self.shard_reader.keys[self._it]
+        shard_data = self.shard_reader.read(shard_key)
+        test_flag = np.random.default_rng([self.random_state, shard_key]).random(len(shard_data)) < self.test_ratio
+        row_flag = test_flag if self.is_test else ~test_flag
+        input_data(
+            data=shard_data.loc[row_flag, self.feature_columns],
+            label=shard_data.loc[row_flag, 'total_sales'].to_numpy(),
+        )
+        self._it += 1
+        return 1
+
+    def reset(self):
+        self._it = 0
+
+
+def train_from_shards(
+    shard_reader,
+    test_ratio: float = 0.25,
+    random_state: int = 0,
+    cache_prefix: str = None,
+) -> xgb.Booster:
+    """Fit XGBoost regressor with shards streamed from disk
+
+    Shards are quantized one by one into QuantileDMatrix, or paged to
+    external memory under cache_prefix if it is set, so the widened
+    training data is never loaded at once. Hyper-parameters are the same
+    as train, with histogram tree method required by both matrices.
+    Requires XGBoost >= 1.7, or >= 1.5 if cache_prefix is set.
+
+    Args:
+        shard_reader (ShardReader): shards written by shardIO.write_shards
+        test_ratio (float, optional): ratio of rows of each shard held out as testing set
+        random_state (int, optional): seed of testing set split
+        cache_prefix (str, optional): path prefix of external memory cache, use in-memory quantized matrix if None
+    """
+    # DataIter with external memory is supported since XGBoost 1.5, QuantileDMatrix since 1.7
+    xgb_version = tuple(int(v) for v in xgb.__version__.split(".")[:2])
+    required_version = (1, 7) if cache_prefix is None else (1, 5)
+    assert xgb_version >= required_version, (
+        f"Training from shards requires XGBoost >= {'.'.join(map(str, required_version))}"
+        f"{'' if cache_prefix is None else ' with cache_prefix'}, found {xgb.__version__}"
+    )
+
+    logger.debug(f"Split Testing Set of {len(shard_reader)} shards, Ratio: {test_ratio:.2f}")
+    if cache_prefix is not None and os.path.dirname(cache_prefix):
+        os.makedirs(os.path.dirname(cache_prefix), exist_ok=True)
+    train_iter = ShardIter(shard_reader, test_ratio, False, random_state, cache_prefix)
+    test_iter = ShardIter(
+        shard_reader,
+        test_ratio,
+        True,
+        random_state,
+        None if cache_prefix is None else f"{cache_prefix}_test",
+    )
+    if cache_prefix is None:
+        train_matrix = xgb.QuantileDMatrix(train_iter)
+        test_matrix = xgb.QuantileDMatrix(test_iter, ref=train_matrix)
+    else:
+        train_matrix = xgb.DMatrix(train_iter)
+        test_matrix = xgb.DMatrix(test_iter)
+    logger.debug(f"Feature count: {train_matrix.num_col()}")
+    logger.debug(f"Feature names: {train_matrix.feature_names}")
+
+    # Fit XGBoost Regressor
+    booster = xgb.train(
+        {
+            "objective": "reg:squarederror",
+            "eta": 0.1,
+            "max_depth": 10,
+            "subsample": 0.75,
+            "colsample_bytree": 0.75,
+            "tree_method": "hist",
+            "eval_metric": "rmse",
+        },
+        train_matrix,
+        num_boost_round=1200,       # Maximum Epoches
+        evals=[(train_matrix, "train"), (test_matrix, "test")],
+        early_stopping_rounds=20,
+        verbose_eval=True,
+    )
+
+    predict_Y = booster.predict(test_matrix, iteration_range=(0, booster.best_iteration + 1))
+    model_rmse = mean_squared_error(test_matrix.get_label(), predict_Y, squared=False)
+
+    logger.debug(f"Prediction RMSE: {model_rmse:.5f}")
+
+    return booster
+
+
 def inference(model, inference_data: pd.DataFrame):
 
 
@@ -189,4 +319,18 @@ def inference(model, inference_data: pd.DataFrame):
     # Update date_block_num to month ID
     inference_data["date_block_num"] = inference_data["date_block_num"].apply(lambda x: (x % 12) + 1)
 
+    # Native booster - reorder columns by feature names, then predict with best iteration
+    if isinstance(model, xgb.Booster):
+        inference_matrix = xgb.DMatrix(
+            inference_data[model.feature_names],
+            feature_names=model.feature_names,
+        )
+        best_iteration = model.attr("best_iteration")
+        if best_iteration is None:
+            return model.predict(inference_matrix)
+        return model.predict(
+            inference_matrix,
+            iteration_range=(0, int(best_iteration) + 1),
+        )
+
     return model.predict(inference_data)
@@ -1,112 +1,463 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
 import numpy as np
 import pandas as pd
 from sklearn.cluster import KMeans
+from threadpoolctl import threadpool_limits
 from loguru import logger
 
+from utils.partitionIndex import PartitionIndex
+
+
+# Available clustering engines of sales heat
+HEAT_ENGINES = ("sklearn", "dp", "lloyd")
+# Monthly heat can also be clustered month by month from previous month's centroids
+MONTHLY_HEAT_ENGINES = HEAT_ENGINES + ("warm",)
+
+# Use full (segment end x segment start) cost matrix in DP if point count is not larger
+DP_DENSE_MAX_POINT = 2048
+
+
+def _segment_cost(prefix_sum, prefix_sq_sum, start, end):
+    # Sum of squared error of sorted points [start, end], inclusive, broadcasted
+    count = end - start + 1
+    segment_sum = prefix_sum[end + 1] - prefix_sum[start]
+    return prefix_sq_sum[end + 1] - prefix_sq_sum[start] - segment_sum ** 2 / count
+
+
+def optimal_1d_kmeans(
+    sorted_value: np.ndarray,
+    n_cluster: int,
+) -> np.ndarray:
+    """Exact k-means of sorted 1-D values by dynamic programming (Ckmeans.1d.dp)
+
+    cost[m, i] is the minimal SSE of the first i + 1 points in m + 1 clusters,
+    each layer is evaluated from the previous one over all possible starts of
+    the last cluster. Optimal starts are monotone in i, so large inputs use
+    divide and conquer instead of the full cost matrix.
+
+    Args:
+        sorted_value (np.ndarray): distinct values in ascending order
+        n_cluster (int): number of clusters
+
+    Returns:
+        np.ndarray: start position of each cluster in sorted_value, ascending
+    """
+    point_count = len(sorted_value)
+    if point_count < n_cluster:
+        raise ValueError(f"n_samples={point_count} should be >= n_clusters={n_cluster}.")
+
+    value = np.asarray(sorted_value, dtype=np.float64)
+    # Center values to reduce cancellation error of prefix sums
+    value = value - value.mean()
+    prefix_sum = np.concatenate(([0.0], np.cumsum(value)))
+    prefix_sq_sum = np.concatenate(([0.0], np.cumsum(value ** 2)))
+
+    position = np.arange(point_count)
+    cost = _segment_cost(prefix_sum, prefix_sq_sum, 0, position)
+    start_table = np.zeros((n_cluster, point_count), dtype=np.int64)
+
+    for m in range(1, n_cluster):
+        prev_cost = cost
+        cost = np.full(point_count, np.inf)
+        if point_count <= DP_DENSE_MAX_POINT:
+            # total[i, j] is cost of points [0, i] with the last cluster starting at j
+            end = position[:, np.newaxis]
+            start = position[np.newaxis, :]
+            total = np.where(
+                (start >= m) & (start <= end),
+                prev_cost[np.maximum(start - 1, 0)] + _segment_cost(prefix_sum, prefix_sq_sum, start, np.maximum(end, start)),
+                np.inf,
+            )
+            start_table[m] = total.argmin(axis=1)
+            cost = total[position, start_table[m]]
+        else:
+            # Evaluate middle end point, then recurse on both halves with bounded start range
+            task_stack = [(m, point_count - 1, m, point_count - 1)]
+            while task_stack:
+                end_lb, end_ub, start_lb, start_ub = task_stack.pop()
+                if end_lb > end_ub:
+                    continue
+                end = (end_lb + end_ub) // 2
+                start = np.arange(start_lb, min(start_ub, end) + 1)
+                total = prev_cost[start - 1] + _segment_cost(prefix_sum, prefix_sq_sum, start, end)
+                best = int(start[total.argmin()])
+                start_table[m, end] = best
+                cost[end] = total.min()
+                task_stack.append((end_lb, end - 1, start_lb, best))
+                task_stack.append((end + 1, end_ub, best, start_ub))
+
+    # Backtrack start position of each cluster
+    cluster_start = np.zeros(n_cluster, dtype=np.int64)
+    end = point_count - 1
+    for m in range(n_cluster - 1, -1, -1):
+        cluster_start[m] = start_table[m, end]
+        end = cluster_start[m] - 1
+    return cluster_start
+
+
+def optimal_heat(
+    sales_sum: np.ndarray,
+    n_cluster: int,
+) -> np.ndarray:
+    """Evaluate sales heat with exact 1-D k-means on distinct positive sales sums
+
+    Clustering runs on sum ** 0.125 as the sklearn engine does. Zero and
+    negative sums are labeled 0, other sums 1 ~ n_cluster in ascending order.
+    """
+    sales_sum = np.asarray(sales_sum, dtype=np.float64)
+    positive_flag = sales_sum > 0
+    distinct_value = np.unique(sales_sum[positive_flag])
+
+    cluster_start = optimal_1d_kmeans(distinct_value ** 0.125, n_cluster)
+    lower_bound = distinct_value[cluster_start]
+
+    sales_heat = np.zeros(len(sales_sum), dtype=np.float64)
+    sales_heat[positive_flag] = np.searchsorted(lower_bound, sales_sum[positive_flag], side="right")
+    return sales_heat
+
+
+def _batched_lloyd(
+    value: np.ndarray,
+    group_id: np.ndarray,
+    centroid: np.ndarray,
+    max_iter: int,
+):
+    # Run Lloyd's iteration of all groups from initial centroids, return label and SSE of each group
+    group_count, n_cluster = centroid.shape
+    label = np.full(len(value), -1, dtype=np.int64)
+    for _ in range(max_iter):
+        # Assignment - centroids stay sorted, so label is count of midpoints below value
+        midpoint = (centroid[:, 1:] + centroid[:, :-1]) / 2
+        new_label = (value[:, np.newaxis] > midpoint[group_id]).sum(axis=1)
+        if np.array_equal(new_label, label):
+            break
+        label = new_label
+
+        # Update - keep centroid of empty cluster
+        flat_label = group_id * n_cluster + label
+        cluster_size = np.bincount(flat_label, minlength=group_count * n_cluster)
+        cluster_sum = np.bincount(flat_label, weights=value, minlength=group_count * n_cluster)
+        centroid = np.where(
+            cluster_size > 0,
+            cluster_sum / np.maximum(cluster_size, 1),
+            centroid.ravel(),
+        ).reshape(group_count, n_cluster)
+
+    group_sse = np.bincount(
+        group_id,
+        weights=(value - centroid[group_id, label]) ** 2,
+        minlength=group_count,
+    )
+    return label, group_sse
+
+
+def batched_1d_kmeans(
+    sorted_value: np.ndarray,
+    group_offset: np.ndarray,
+    n_cluster: int,
+    n_init: int = 3,
+    max_iter: int = 300,
+) -> np.ndarray:
+    """Run Lloyd's iteration of 1-D k-means on every group at once
+
+    Values of all groups are kept in one array, sorted within each group, and
+    group g occupies sorted_value[group_offset[g]:group_offset[g + 1]].
+    Assignment compares each value with midpoints of its group's centroids,
+    update sums values by (group, label) with one bincount.
+
+    Initial centroids blend within-group quantiles and evenly spaced points of
+    the group's value range, from pure quantile to pure range over n_init runs.
+    The run with the lowest SSE is kept per group, so the result is deterministic.
+
+    Args:
+        sorted_value (np.ndarray): values of all groups, ascending within group
+        group_offset (np.ndarray): start position of each group, with total length appended
+        n_cluster (int): number of clusters of each group
+        n_init (int, optional): number of initializations
+        max_iter (int, optional): maximum number of iterations of each run
+
+    Returns:
+        np.ndarray: label of each value, ascending with value within group
+    """
+    group_offset = np.asarray(group_offset, dtype=np.int64)
+    group_size = np.diff(group_offset)
+    group_id = np.repeat(np.arange(len(group_size)), group_size)
+    value = np.asarray(sorted_value, dtype=np.float64)
+    if len(value) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Candidate initial centroids of each group
+    cluster_fraction = (np.arange(n_cluster) + 0.5) / n_cluster
+    last_position = np.maximum(group_offset[1:] - 1, group_offset[:-1])[:, np.newaxis]
+    quantile_position = group_offset[:-1, np.newaxis] + (cluster_fraction * group_size[:, np.newaxis]).astype(np.int64)
+    quantile_centroid = value[np.minimum(np.minimum(quantile_position, last_position), len(value) - 1)]
+    group_min = value[np.minimum(group_offset[:-1], len(value) - 1)][:, np.newaxis]
+    group_max = value[np.minimum(last_position, len(value) - 1)]
+    range_centroid = group_min + cluster_fraction * (group_max - group_min)
+
+    best_label = None
+    for init_iter in range(n_init):
+        blend = init_iter / max(n_init - 1, 1)
+        label, group_sse = _batched_lloyd(
+            value,
+            group_id,
+            (1 - blend) * quantile_centroid + blend * range_centroid,
+            max_iter,
+        )
+        if best_label is None:
+            best_label, best_sse = label, group_sse
+            continue
+
+        # Keep better run of each group
+        better_flag = group_sse < best_sse
+        best_label = np.where(better_flag[group_id], label, best_label)
+        best_sse = np.where(better_flag, group_sse, best_sse)
+
+    return best_label
+
+
+def batched_heat(
+    sales_sum: np.ndarray,
+    group_key: np.ndarray,
+    n_cluster: int,
+    min_distinct: int = 0,
+) -> np.ndarray:
+    """Evaluate sales heat of all groups with batched Lloyd's iteration
+
+    Distinct positive sums of each group are clustered on sum ** 0.125. Zero
+    and negative sums are labeled 0, other sums 1 ~ n_cluster in ascending
+    order, empty clusters are skipped. Groups with no more than min_distinct
+    distinct positive sums are not clustered and labeled 1.
+
+    Args:
+        sales_sum (np.ndarray): sales sum of each row
+        group_key (np.ndarray): integer group key of each row, e.g. date_block_num
+        n_cluster (int): number of clusters of each group
+        min_distinct (int, optional): minimum distinct positive sums for clustering
+    """
+    sales_sum = np.asarray(sales_sum, dtype=np.float64)
+    sales_heat = np.zeros(len(sales_sum), dtype=np.float64)
+    positive_position = np.flatnonzero(sales_sum > 0)
+    if len(positive_position) == 0:
+        return sales_heat
+
+    # Step 1. Sort positive rows by (group, sum), then keep distinct (group, sum)
+    _, group_code = np.unique(np.asarray(group_key)[positive_position], return_inverse=True)
+    order = np.lexsort((sales_sum[positive_position], group_code))
+    sorted_group = group_code[order]
+    sorted_sum = sales_sum[positive_position][order]
+    distinct_flag = np.ones(len(order), dtype=bool)
+    distinct_flag[1:] = (sorted_group[1:] != sorted_group[:-1]) | (sorted_sum[1:] != sorted_sum[:-1])
+    distinct_position = np.cumsum(distinct_flag) - 1
+
+    distinct_group = sorted_group[distinct_flag]
+    distinct_sum = sorted_sum[distinct_flag]
+    group_size = np.bincount(distinct_group)
+    group_offset = np.concatenate(([0], np.cumsum(group_size)))
+
+    # Step 2. Cluster groups with enough distinct sums
+    cluster_flag = (group_size > min_distinct) & (group_size >= n_cluster)
+    distinct_heat = np.ones(len(distinct_sum), dtype=np.float64)
+    point_flag = cluster_flag[distinct_group]
+    if point_flag.any():
+        label = batched_1d_kmeans(
+            distinct_sum[point_flag] ** 0.125,
+            np.concatenate(([0], np.cumsum(group_size[cluster_flag]))),
+            n_cluster,
+        )
 
-def extract_sales_heat(
+        # Dense rank of labels within group, skip empty clusters
+        flat_label = distinct_group[point_flag] * n_cluster + label
+        nonempty_flag = np.zeros(len(group_size) * n_cluster, dtype=bool)
+        nonempty_flag[flat_label] = True
+        label_rank = np.cumsum(nonempty_flag.reshape(-1, n_cluster), axis=1).ravel()
+        distinct_heat[point_flag] = label_rank[flat_label]
+
+    sales_heat[positive_position[order]] = distinct_heat[distinct_position]
+    return sales_heat
+
+
+def extract_sales_heat_old(
     sales_info: pd.DataFrame,
 ):
-    N_CLUSTER = 3
-
     # date_block_num  shop_id  item_category_id  cat_shop_total_sales_sum  cat_shop_total_sales_mean
     final_data_list = []
     for i in range(60):
         logger.debug(f"Shop: {i}")
         for j in range(34):
-            # Copy sales info
+            # Copy sales info, then cluster it with unseeded KMeans
             km_train_data = sales_info.query(f"shop_id == {i} and date_block_num == {j}").copy()
-            # print(km_train_data)
-
-            # Remove duplicated value and Zero Value
-            km_cluster_data = km_train_data.loc[~km_train_data["cat_shop_total_sales_sum"].duplicated()].query("cat_shop_total_sales_sum > 0")
-
-            range_list = []
-            if len(km_cluster_data) > 10:
-                # Do Normalization for Clustering
-                km_cluster_data["cat_shop_total_sales_sum_norm"] = km_cluster_data["cat_shop_total_sales_sum"].apply(lambda x: x ** 0.125)
-
-                # Do Clustering
-                km_cluster_data["cat_shop_sales_heat"] = KMeans(n_clusters=N_CLUSTER).fit_predict(km_cluster_data[["cat_shop_total_sales_sum_norm"]])
-                # print(km_cluster_data[["total_sales_sum", "cat_shop_sales_heat"]])
-                # print(km_cluster_data["cat_shop_sales_heat"].min(), km_cluster_data["cat_shop_sales_heat"].max())
-
-                # Do Heat Adjustment by range - sort range
-                for it in range(N_CLUSTER):
-                    temp_mapper = km_cluster_data.query(f"cat_shop_sales_heat == {it}")
-                    range_tuple = (
-                        temp_mapper["cat_shop_total_sales_sum"].min(),
-                        temp_mapper["cat_shop_total_sales_sum"].max(),
-                        it + 1
-                    )
-                    range_list.append(range_tuple)
-
-                # Join Final Result of Joined Data
-                final_data = km_train_data.join(
-                    km_cluster_data["cat_shop_sales_heat"],
-                    how='left'
-                ).copy()
-                # print(final_data)
-
-                # Label Zero Sales range info in range list
-                final_data.loc[
-                    final_data["cat_shop_total_sales_sum"] == 0,
+            final_data_list.append(_shop_month_heat(km_train_data))
+
+    sales_info_with_heat = pd.concat(
+        final_data_list,
+        axis=0,
+    ).sort_index()
+
+    assert not sales_info_with_heat.isna().values.any(), "Info includes NaN"
+
+    return sales_info_with_heat
+
+
+def _init_heat_worker():
+    # One OpenMP thread per worker process, avoid oversubscription of KMeans
+    threadpool_limits(limits=1)
+
+
+def _shop_month_heat(
+    km_train_data: pd.DataFrame,
+    random_state: int = None,
+    engine: str = "sklearn",
+) -> pd.DataFrame:
+    """Cluster category sales heat of a single (shop_id, date_block_num) partition"""
+    N_CLUSTER = 3
+
+    if engine == "dp":
+        final_data = km_train_data.copy()
+        sales_sum = final_data["cat_shop_total_sales_sum"].to_numpy()
+        if len(np.unique(sales_sum[sales_sum > 0])) > 10:
+            final_data["cat_shop_sales_heat"] = optimal_heat(sales_sum, N_CLUSTER)
+        else:
+            final_data["cat_shop_sales_heat"] = (sales_sum > 0).astype(np.int64)
+        return final_data
+
+    # Remove duplicated value and Zero Value
+    km_cluster_data = km_train_data.loc[~km_train_data["cat_shop_total_sales_sum"].duplicated()]
+    km_cluster_data = km_cluster_data.loc[km_cluster_data["cat_shop_total_sales_sum"] > 0].copy()
+
+    range_list = []
+    if len(km_cluster_data) > 10:
+        # Do Normalization for Clustering
+        km_cluster_data["cat_shop_total_sales_sum_norm"] = km_cluster_data["cat_shop_total_sales_sum"].apply(lambda x: x ** 0.125)
+
+        # Do Clustering
+        km_cluster_data["cat_shop_sales_heat"] = KMeans(n_clusters=N_CLUSTER, random_state=random_state).fit_predict(km_cluster_data[["cat_shop_total_sales_sum_norm"]])
+
+        # Do Heat Adjustment by range - sort range
+        for it in range(N_CLUSTER):
+            temp_mapper = km_cluster_data.loc[km_cluster_data["cat_shop_sales_heat"] == it]
+            range_tuple = (
+                temp_mapper["cat_shop_total_sales_sum"].min(),
+                temp_mapper["cat_shop_total_sales_sum"].max(),
+                it + 1
+            )
+            range_list.append(range_tuple)
+
+        # Join Final Result of Joined Data
+        final_data = km_train_data.join(
+            km_cluster_data["cat_shop_sales_heat"],
+            how='left'
+        ).copy()
+
+        # Label Zero Sales range info in range list
+        final_data.loc[
+            final_data["cat_shop_total_sales_sum"] == 0,
+            "cat_shop_sales_heat"
+        ] = 0
+
+        for lb, ub, label_value in range_list:
+            final_data.loc[
+                    (final_data["cat_shop_total_sales_sum"] >= lb)
+                    & (final_data["cat_shop_total_sales_sum"] <= ub),
                     "cat_shop_sales_heat"
-                ] = 0
-
-                for lb, ub, label_value in range_list:
-                    # print(lb, ub, label_value)
-                    final_data.loc[
-                            (final_data["cat_shop_total_sales_sum"] >= lb)
-                            & (final_data["cat_shop_total_sales_sum"] <= ub),
-                            "cat_shop_sales_heat"
-                    ] = label_value
-                    # print(final_data.loc[
-                    #             (final_data["cat_shop_total_sales_sum"] >= lb) & (final_data["cat_shop_total_sales_sum"] <= ub)
-                    #     ]
-                    # )
-
-                # Sort List
-                range_list.sort(key=lambda x: x[0])
-                # print(range_list)
-
-                # Re-mapping sales heat
-                heat_mapper = {0: 0}
-                for it in range(N_CLUSTER):
-                    heat_mapper[
-                        range_list[it][2]
-                    ] = it + 1
-                final_data["cat_shop_sales_heat"].replace(
-                    heat_mapper,
-                    inplace=True,
-                )
+            ] = label_value
 
-                assert not final_data.isna().values.any(), "Final Data Includes NaN"
-                assert len(final_data) == 84, "Length Error"
-            elif len(km_cluster_data) > 0:
-                # print(f"Shop: {i}, Date_Block_Num: {j}")
-                # print(km_cluster_data)
-                final_data = km_train_data.copy()
-                final_data["cat_shop_sales_heat"] = pd.Series(
-                    [0 for _ in range(len(km_train_data))],
-                    index=km_train_data.index
-                )
+        # Sort List
+        range_list.sort(key=lambda x: x[0])
 
-                final_data.loc[final_data["cat_shop_total_sales_sum"] > 0, "cat_shop_sales_heat"] = 1
-                # print(final_data)
-                assert len(final_data) == 84, "Length Error"
-            else:
-                final_data = km_train_data.copy()
-                final_data["cat_shop_sales_heat"] = pd.Series(
-                    [0 for _ in range(len(km_train_data))],
-                    index=km_train_data.index
-                )
-                # print(final_data)
+        # Re-mapping sales heat
+        heat_mapper = {0: 0}
+        for it in range(N_CLUSTER):
+            heat_mapper[
+                range_list[it][2]
+            ] = it + 1
+        final_data["cat_shop_sales_heat"].replace(
+            heat_mapper,
+            inplace=True,
+        )
 
+        assert not final_data.isna().values.any(), "Final Data Includes NaN"
+        assert len(final_data) == 84, "Length Error"
+    elif len(km_cluster_data) > 0:
+        final_data = km_train_data.copy()
+        final_data["cat_shop_sales_heat"] = pd.Series(
+            [0 for _ in range(len(km_train_data))],
+            index=km_train_data.index
+        )
+
+        final_data.loc[final_data["cat_shop_total_sales_sum"] > 0, "cat_shop_sales_heat"] = 1
+        assert len(final_data) == 84, "Length Error"
+    else:
+        final_data = km_train_data.copy()
+        final_data["cat_shop_sales_heat"] = pd.Series(
+            [0 for _ in range(len(km_train_data))],
+            index=km_train_data.index
+        )
+
+    return final_data
+
+
+def extract_sales_heat(
+    sales_info: pd.DataFrame,
+    n_jobs: int = 1,
+    random_state: int = None,
+    engine: str = "sklearn",
+):
+    """Cluster category sales heat of each (shop_id, date_block_num) partition
+
+    Table is sorted into partitions once by PartitionIndex, then partitions are
+    clustered serially or fanned out over a process pool. Seed of each partition
+    only depends on random_state, shop_id and date_block_num, so output does not
+    depend on n_jobs.
+
+    Args:
+        sales_info (pd.DataFrame): output of shop_seasonal_sales_of_category
+        n_jobs (int, optional): number of worker processes, serial if 1
+        random_state (int, optional): base seed of KMeans, unseeded if None
+        engine (str, optional): "sklearn" for KMeans, "dp" for exact 1-D k-means,
+            "lloyd" for batched Lloyd's iteration over all partitions in this process
+    """
+    assert engine in HEAT_ENGINES, f"Unknown clustering engine: {engine}"
+    N_CLUSTER = 3
 
-            final_data_list.append(final_data)
-            # print(final_data)
-            # print(final_data.isna().values.any())
+    if engine == "lloyd":
+        sales_info_with_heat = sales_info.copy()
+        sales_info_with_heat["cat_shop_sales_heat"] = batched_heat(
+            sales_info["cat_shop_total_sales_sum"].to_numpy(),
+            _encode_group(sales_info, ["shop_id", "date_block_num"]),
+            N_CLUSTER,
+            min_distinct=10,
+        )
+        return sales_info_with_heat.sort_index()
+
+    # date_block_num  shop_id  item_category_id  cat_shop_total_sales_sum  cat_shop_total_sales_mean
+    partition_list = []
+    seed_list = []
+    for (shop_id, date_block_num), km_train_data in PartitionIndex(sales_info, ["shop_id", "date_block_num"]):
+        partition_list.append(km_train_data)
+        seed_list.append(
+            None if random_state is None else random_state + int(shop_id) * 34 + int(date_block_num)
+        )
+
+    logger.debug(f"Cluster {len(partition_list)} (shop, month) partitions with {n_jobs} worker(s)")
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_heat_worker) as executor:
+            final_data_list = list(
+                executor.map(
+                    _shop_month_heat,
+                    partition_list,
+                    seed_list,
+                    [engine] * len(partition_list),
+                    chunksize=max(len(partition_list) // (n_jobs * 4), 1),
+                )
+            )
+    else:
+        final_data_list = [
+            _shop_month_heat(km_train_data, seed, engine)
+            for km_train_data, seed in zip(partition_list, seed_list)
+        ]
 
     sales_info_with_heat = pd.concat(
         final_data_list,
@@ -119,7 +470,9 @@ def extract_sales_heat(
 
 
 def extract_monthly_item_sales_heat(
-    input_data: pd.DataFrame
+    input_data: pd.DataFrame,
+    engine: str = "sklearn",
+    random_state: int = None,
 ):
     #------------------------------------------------
     # date_block_num, item_id,
@@ -127,13 +480,48 @@ def extract_monthly_item_sales_heat(
     # monthly_total_item_sales_mean
     #------------------------------------------------
     N_CLUSTER = 5
+    assert engine in MONTHLY_HEAT_ENGINES, f"Unknown clustering engine: {engine}"
+
+    # Warm-started KMeans clusters each month from previous month's centroids
+    if engine == "warm":
+        final_data = warm_start_monthly_heat(
+            input_data.loc[input_data["date_block_num"].isin(range(34))],
+            "monthly_item",
+            n_cluster=N_CLUSTER,
+            random_state=random_state,
+        )
+        assert len(final_data) == 34*22170, "Length of output is incorrect"
+        return final_data
+
+    # Batched Lloyd's iteration clusters all months at once
+    if engine == "lloyd":
+        final_data = input_data.loc[input_data["date_block_num"].isin(range(34))].copy()
+        final_data["monthly_total_item_sales_heat"] = batched_heat(
+            final_data["monthly_total_item_sales_sum"].to_numpy(),
+            final_data["date_block_num"].to_numpy(),
+            N_CLUSTER,
+        )
+        assert len(final_data) == 34*22170, "Length of output is incorrect"
+        return final_data.sort_index()
+
+    # Sort by month once, each month is a contiguous slice
+    month_index = PartitionIndex(input_data, ["date_block_num"])
 
     final_data_list = []
     for month_iter in range(34):
         logger.debug(f"Month: {month_iter}")
 
         # Extract Train Data
-        km_train_data = input_data.query(f"date_block_num == {month_iter}").copy()
+        km_train_data = month_index.get((month_iter,)).copy()
+
+        # Exact 1-D clustering gives ordered heat directly
+        if engine == "dp":
+            km_train_data["monthly_total_item_sales_heat"] = optimal_heat(
+                km_train_data["monthly_total_item_sales_sum"].to_numpy(),
+                N_CLUSTER,
+            )
+            final_data_list.append(km_train_data)
+            continue
         # print(
         #     km_train_data["monthly_total_item_sales_sum"].min(),
         #     km_train_data["monthly_total_item_sales_sum"].max()
@@ -141,12 +529,10 @@ def extract_monthly_item_sales_heat(
 
         # Remove duplicated value and Zero Value
         # TODO: Check Points for clustering
-        km_cluster_data = (
-            km_train_data.loc[
-                ~km_train_data["monthly_total_item_sales_sum"].duplicated()
-            ]
-            .query("monthly_total_item_sales_sum > 0")
-        )
+        km_cluster_data = km_train_data.loc[
+            ~km_train_data["monthly_total_item_sales_sum"].duplicated()
+        ]
+        km_cluster_data = km_cluster_data.loc[km_cluster_data["monthly_total_item_sales_sum"] > 0].copy()
 
         range_list = []
         # Do Normalization for Clustering
@@ -156,14 +542,18 @@ def extract_monthly_item_sales_heat(
 
         # Do Clustering
         km_cluster_data["monthly_total_item_sales_heat"] = (
-            KMeans(n_clusters=N_CLUSTER).fit_predict(
+            KMeans(
+                n_clusters=N_CLUSTER,
+                n_init=10,
+                random_state=None if random_state is None else random_state + month_iter,
+            ).fit_predict(
                 km_cluster_data[["monthly_total_item_sales_sum_norm"]]
             )
         )
 
         # Do Heat Adjustment by range - add to list
         for it in range(N_CLUSTER):
-            temp_mapper = km_cluster_data.query(f"monthly_total_item_sales_heat == {it}")
+            temp_mapper = km_cluster_data.loc[km_cluster_data["monthly_total_item_sales_heat"] == it]
             # Don`t forget to denormalize
             range_tuple = (
                 temp_mapper["monthly_total_item_sales_sum"].min(),
@@ -226,7 +616,9 @@ def extract_monthly_item_sales_heat(
 
 
 def extract_monthly_item_cat_sales_heat(
-    input_data: pd.DataFrame
+    input_data: pd.DataFrame,
+    engine: str = "sklearn",
+    random_state: int = None,
 ):
     #------------------------------------------------
     # date_block_num, item_id,
@@ -234,13 +626,48 @@ def extract_monthly_item_cat_sales_heat(
     # monthly_total_item_cat_sales_mean
     #------------------------------------------------
     N_CLUSTER = 5
+    assert engine in MONTHLY_HEAT_ENGINES, f"Unknown clustering engine: {engine}"
+
+    # Warm-started KMeans clusters each month from previous month's centroids
+    if engine == "warm":
+        final_data = warm_start_monthly_heat(
+            input_data.loc[input_data["date_block_num"].isin(range(34))],
+            "monthly_item_cat",
+            n_cluster=N_CLUSTER,
+            random_state=random_state,
+        )
+        assert len(final_data) == 34*84, "Length of output is incorrect"
+        return final_data
+
+    # Batched Lloyd's iteration clusters all months at once
+    if engine == "lloyd":
+        final_data = input_data.loc[input_data["date_block_num"].isin(range(34))].copy()
+        final_data["monthly_total_item_cat_sales_heat"] = batched_heat(
+            final_data["monthly_total_item_cat_sales_sum"].to_numpy(),
+            final_data["date_block_num"].to_numpy(),
+            N_CLUSTER,
+        )
+        assert len(final_data) == 34*84, "Length of output is incorrect"
+        return final_data.sort_index()
+
+    # Sort by month once, each month is a contiguous slice
+    month_index = PartitionIndex(input_data, ["date_block_num"])
 
     final_data_list = []
     for month_iter in range(34):
         logger.debug(f"Month: {month_iter}")
 
         # Extract Train Data
-        km_train_data = input_data.query(f"date_block_num == {month_iter}").copy()
+        km_train_data = month_index.get((month_iter,)).copy()
+
+        # Exact 1-D clustering gives ordered heat directly
+        if engine == "dp":
+            km_train_data["monthly_total_item_cat_sales_heat"] = optimal_heat(
+                km_train_data["monthly_total_item_cat_sales_sum"].to_numpy(),
+                N_CLUSTER,
+            )
+            final_data_list.append(km_train_data)
+            continue
         # print(
         #     km_train_data["monthly_total_item_sales_sum"].min(),
         #     km_train_data["monthly_total_item_sales_sum"].max()
@@ -248,12 +675,10 @@ def extract_monthly_item_cat_sales_heat(
 
         # Remove duplicated value and Zero Value
         # TODO: Check Points for clustering
-        km_cluster_data = (
-            km_train_data.loc[
-                ~km_train_data["monthly_total_item_cat_sales_sum"].duplicated()
-            ]
-            .query("monthly_total_item_cat_sales_sum > 0")
-        )
+        km_cluster_data = km_train_data.loc[
+            ~km_train_data["monthly_total_item_cat_sales_sum"].duplicated()
+        ]
+        km_cluster_data = km_cluster_data.loc[km_cluster_data["monthly_total_item_cat_sales_sum"] > 0].copy()
 
         range_list = []
         # Do Normalization for Clustering
@@ -263,14 +688,18 @@ def extract_monthly_item_cat_sales_heat(
 
         # Do Clustering
         km_cluster_data["monthly_total_item_cat_sales_heat"] = (
-            KMeans(n_clusters=N_CLUSTER).fit_predict(
+            KMeans(
+                n_clusters=N_CLUSTER,
+                n_init=10,
+                random_state=None if random_state is None else random_state + month_iter,
+            ).fit_predict(
                 km_cluster_data[["monthly_total_item_cat_sales_sum_norm"]]
             )
         )
 
         # Do Heat Adjustment by range - add to list
         for it in range(N_CLUSTER):
-            temp_mapper = km_cluster_data.query(f"monthly_total_item_cat_sales_heat == {it}")
+            temp_mapper = km_cluster_data.loc[km_cluster_data["monthly_total_item_cat_sales_heat"] == it]
             # Don`t forget to denormalize
             range_tuple = (
                 temp_mapper["monthly_total_item_cat_sales_sum"].min(),
@@ -332,3 +761,229 @@ def extract_monthly_item_cat_sales_heat(
     assert len(monthly_total_item_cat_sales_with_heat) == 34*84, "Length of output is incorrect"
 
     return monthly_total_item_cat_sales_with_heat
+
+
+# (group columns, sales sum column, heat column) of each heat feature
+HEAT_THRESHOLD_SPECS = {
+    "cat_shop": (["shop_id", "date_block_num"], "cat_shop_total_sales_sum", "cat_shop_sales_heat"),
+    "monthly_item": (["date_block_num"], "monthly_total_item_sales_sum", "monthly_total_item_sales_heat"),
+    "monthly_item_cat": (["date_block_num"], "monthly_total_item_cat_sales_sum", "monthly_total_item_cat_sales_heat"),
+}
+
+
+def _encode_group(input_data: pd.DataFrame, group_columns: List[str]) -> np.ndarray:
+    # Encode group key tuples into one sortable integer
+    group_key = np.zeros(len(input_data), dtype=np.int64)
+    for col in group_columns:
+        group_key = group_key * (1 << 20) + input_data[col].to_numpy(dtype=np.int64)
+    return group_key
+
+
+def heat_threshold_table(
+    heat_data: pd.DataFrame,
+    name: str,
+) -> pd.DataFrame:
+    """Summarize heat labels as sorted lower bounds of sales sum per group
+
+    Heat of every engine is ascending with sales sum within a group, so label h
+    covers sums from the lowest sum labeled h to the next lower bound.
+
+    Args:
+        heat_data (pd.DataFrame): output of a heat extractor
+        name (str): key of HEAT_THRESHOLD_SPECS
+
+    Returns:
+        pd.DataFrame: group columns and heat_{h}_lb for h = 1 ~ max heat, NaN if heat h is absent
+    """
+    group_columns, sum_column, heat_column = HEAT_THRESHOLD_SPECS[name]
+    labeled_data = heat_data.loc[heat_data[heat_column] > 0]
+
+    threshold_table = (
+        labeled_data.groupby(group_columns + [heat_column])[sum_column]
+        .min()
+        .unstack(heat_column)
+    )
+    threshold_table.columns = [f"heat_{int(heat)}_lb" for heat in threshold_table.columns]
+    return threshold_table.reset_index()
+
+
+def assign_heat(
+    threshold_table: pd.DataFrame,
+    input_data: pd.DataFrame,
+    name: str,
+) -> np.ndarray:
+    """Assign heat label to sales sums with threshold table
+
+    Zero and negative sums are labeled 0, positive sums the highest label whose
+    lower bound they reach, or 1 if none. NaN bound of an absent label is never
+    reached, so it does not shift higher labels. Sums of groups missing in
+    table are labeled NaN.
+
+    Args:
+        threshold_table (pd.DataFrame): output of heat_threshold_table
+        input_data (pd.DataFrame): data with group columns and sales sum column
+        name (str): key of HEAT_THRESHOLD_SPECS
+    """
+    group_columns, sum_column, _ = HEAT_THRESHOLD_SPECS[name]
+    bound_columns = sorted(
+        [col for col in threshold_table.columns if col.startswith("heat_")],
+        key=lambda col: int(col.split("_")[1]),
+    )
+
+    # Locate threshold row of each input row
+    table_key = _encode_group(threshold_table, group_columns)
+    order = np.argsort(table_key, kind="stable")
+    table_key = table_key[order]
+    bound_np = threshold_table[bound_columns].to_numpy(dtype=np.float64)[order]
+
+    input_key = _encode_group(input_data, group_columns)
+    position = np.searchsorted(table_key, input_key).clip(0, max(len(table_key) - 1, 0))
+    found_flag = (table_key[position] == input_key) if len(table_key) else np.zeros(len(input_key), dtype=bool)
+
+    # Highest label of reached lower bounds, comparison with NaN bound is False
+    label_np = np.array([int(col.split("_")[1]) for col in bound_columns], dtype=np.float64)
+    sales_sum = input_data[sum_column].to_numpy(dtype=np.float64)
+    reached_flag = sales_sum[:, np.newaxis] >= bound_np[position]
+    sales_heat = np.where(reached_flag, label_np, 1.0).max(axis=1, initial=1.0)
+    sales_heat[sales_sum <= 0] = 0
+    sales_heat[~found_flag] = np.nan
+    return sales_heat
+
+
+def label_heat_table(
+    stat_table: pd.DataFrame,
+    threshold_table: pd.DataFrame,
+    name: str,
+) -> pd.DataFrame:
+    """Rebuild heat table of a statistic table with threshold table, same columns as heat extractors"""
+    _, _, heat_column = HEAT_THRESHOLD_SPECS[name]
+    heat_table = stat_table.copy()
+    heat_table[heat_column] = assign_heat(threshold_table, stat_table, name)
+    return heat_table
+
+
+def heat_centroid_table(
+    heat_data: pd.DataFrame,
+    name: str,
+) -> pd.DataFrame:
+    """Evaluate centroid of each heat label per group in clustering space (sum ** 0.125)
+
+    Centroid of a converged cluster is the mean of its distinct positive sums.
+
+    Args:
+        heat_data (pd.DataFrame): output of a heat extractor
+        name (str): key of HEAT_THRESHOLD_SPECS
+
+    Returns:
+        pd.DataFrame: group columns and centroid_{h} for h = 1 ~ max heat
+    """
+    group_columns, sum_column, heat_column = HEAT_THRESHOLD_SPECS[name]
+    distinct_data = heat_data.loc[heat_data[heat_column] > 0].drop_duplicates(group_columns + [sum_column])
+
+    centroid_table = (
+        distinct_data.assign(sales_sum_norm=distinct_data[sum_column] ** 0.125)
+        .groupby(group_columns + [heat_column])["sales_sum_norm"]
+        .mean()
+        .unstack(heat_column)
+    )
+    centroid_table.columns = [f"centroid_{int(heat)}" for heat in centroid_table.columns]
+    return centroid_table.reset_index()
+
+
+def warm_start_monthly_heat(
+    input_data: pd.DataFrame,
+    name: str,
+    init_centroid: np.ndarray = None,
+    n_cluster: int = 5,
+    random_state: int = None,
+    n_init: int = 10,
+) -> pd.DataFrame:
+    """Cluster monthly heat in ascending month order, each month starts from previous month's centroids
+
+    Only the first month is initialized by k-means++ with several runs, unless
+    init_centroid is given. Later months run one KMeans from the sorted
+    centroids of the previous month, which converges in a few iterations as
+    the sales distribution changes slowly.
+
+    Args:
+        input_data (pd.DataFrame): monthly statistic, e.g. output of item_total_sales
+        name (str): "monthly_item" or "monthly_item_cat"
+        init_centroid (np.ndarray, optional): centroids of the month before the first month, e.g. from heat_centroid_table
+        n_cluster (int, optional): number of clusters
+        random_state (int, optional): seed of KMeans, unseeded if None
+        n_init (int, optional): number of k-means++ runs of the first month
+
+    Returns:
+        pd.DataFrame: input_data with heat column, labeled 0 for zero sales and 1 ~ n_cluster ascending
+    """
+    _, sum_column, heat_column = HEAT_THRESHOLD_SPECS[name]
+    centroid = None if init_centroid is None else np.sort(np.asarray(init_centroid, dtype=np.float64))
+
+    final_data_list = []
+    for month_iter, month_data in PartitionIndex(input_data, ["date_block_num"]):
+        final_data = month_data.copy()
+        sales_sum = final_data[sum_column].to_numpy(dtype=np.float64)
+        positive_flag = sales_sum > 0
+        distinct_value = np.unique(sales_sum[positive_flag])
+
+        if centroid is None:
+            km_model = KMeans(n_clusters=n_cluster, n_init=n_init, random_state=random_state)
+        else:
+            km_model = KMeans(n_clusters=n_cluster, init=centroid.reshape(-1, 1), n_init=1, random_state=random_state)
+        km_model.fit((distinct_value ** 0.125).reshape(-1, 1))
+        logger.debug(f"Month: {month_iter}, iterations: {km_model.n_iter_}")
+
+        # Order clusters by centroid, which also orders sales ranges
+        cluster_order = np.argsort(km_model.cluster_centers_.ravel())
+        cluster_rank = np.empty(n_cluster, dtype=np.int64)
+        cluster_rank[cluster_order] = np.arange(n_cluster)
+        centroid = km_model.cluster_centers_.ravel()[cluster_order]
+
+        sales_heat = np.zeros(len(sales_sum), dtype=np.float64)
+        sales_heat[positive_flag] = cluster_rank[
+            km_model.labels_[np.searchsorted(distinct_value, sales_sum[positive_flag])]
+        ] + 1
+        final_data[heat_column] = sales_heat
+        final_data_list.append(final_data)
+
+    return pd.concat(final_data_list, axis=0).sort_index()
+
+
+def append_monthly_heat(
+    heat_data: pd.DataFrame,
+    new_month_stat: pd.DataFrame,
+    name: str,
+    n_cluster: int = 5,
+    random_state: int = None,
+    n_init: int = 10,
+) -> pd.DataFrame:
+    """Cluster heat of newly appended months only, warm-started from the last stored month
+
+    Existing months are not refit, their centroids are recovered from heat_data.
+
+    Args:
+        heat_data (pd.DataFrame): existing output of a monthly heat extractor
+        new_month_stat (pd.DataFrame): monthly statistic of new months only
+        name (str): "monthly_item" or "monthly_item_cat"
+        n_cluster (int, optional): number of clusters
+        random_state (int, optional): seed of KMeans, unseeded if None
+        n_init (int, optional): number of k-means++ runs if new months are initialized from scratch
+    """
+    assert not heat_data["date_block_num"].isin(new_month_stat["date_block_num"].unique()).any(), "Month to be appended already exists in heat table"
+
+    centroid_table = heat_centroid_table(heat_data, name)
+    last_centroid = (
+        centroid_table.loc[centroid_table["date_block_num"].idxmax()]
+        .drop("date_block_num")
+        .dropna()
+        .to_numpy(dtype=np.float64)
+    )
+    if len(last_centroid) != n_cluster:
+        logger.warning(f"Last month has {len(last_centroid)} clusters, initialize new months from scratch")
+        last_centroid = None
+
+    new_heat_data = warm_start_monthly_heat(new_month_stat, name, last_centroid, n_cluster, random_state, n_init)
+    return pd.concat(
+        [heat_data, new_heat_data[heat_data.columns]],
+        ignore_index=True,
+    )
@@ -1,11 +1,15 @@
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+
 import numpy as np
 import pandas as pd
 from loguru import logger
 from pandarallel import pandarallel
 
 from utils import csvIO
+from utils.partitionIndex import PartitionIndex
+from preprocessor import data_validator
 
-def integrate_monthly_sales(
+def integrate_monthly_sales_old(
     input_data: pd.DataFrame,
 ) -> pd.DataFrame:
     # <<<<<<<<<<<<<<<<<<<<<<Schema of input data>>>>>>>>>>>>>>>>>>>>>>
@@ -109,6 +113,232 @@ def integrate_monthly_sales(
     return agg_sales
 
 
+# Bit offset of each component of encoded monthly sales key
+_SALES_KEY_SHOP_SHIFT = 24
+_SALES_KEY_MONTH_SHIFT = 40
+_SALES_KEY_ITEM_MASK = (1 << _SALES_KEY_SHOP_SHIFT) - 1
+_SALES_KEY_SHOP_MASK = (1 << (_SALES_KEY_MONTH_SHIFT - _SALES_KEY_SHOP_SHIFT)) - 1
+
+# Running sums kept for each (date_block_num, shop_id, item_id)
+_PARTIAL_SALES_COLUMNS = [
+    "general_record_count",
+    "general_sales_count",
+    "general_price_sum",
+    "refund_record_count",
+    "refund_sales_count",
+]
+
+
+def _encode_sales_key(
+    date_block_num: np.ndarray,
+    shop_id: np.ndarray,
+    item_id: np.ndarray,
+) -> np.ndarray:
+    # Ordering of encoded key is the same as ordering of (date_block_num, shop_id, item_id)
+    return (
+        (date_block_num.astype(np.int64) << _SALES_KEY_MONTH_SHIFT)
+        | (shop_id.astype(np.int64) << _SALES_KEY_SHOP_SHIFT)
+        | item_id.astype(np.int64)
+    )
+
+
+def _decode_sales_key(sales_key: np.ndarray) -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "date_block_num": sales_key >> _SALES_KEY_MONTH_SHIFT,
+            "shop_id": (sales_key >> _SALES_KEY_SHOP_SHIFT) & _SALES_KEY_SHOP_MASK,
+            "item_id": sales_key & _SALES_KEY_ITEM_MASK,
+        }
+    )
+
+
+def _reduce_by_key(
+    sales_key: np.ndarray,
+    value_dict: dict,
+) -> pd.DataFrame:
+    # Sort encoded key once, then sum all value columns by segment
+    unique_key, key_inverse = np.unique(sales_key, return_inverse=True)
+    return pd.DataFrame(
+        {
+            col: np.bincount(key_inverse, weights=value, minlength=len(unique_key))
+            for col, value in value_dict.items()
+        },
+        index=pd.Index(unique_key, name="sales_key"),
+    )
+
+
+def _partial_monthly_sales(
+    input_data: pd.DataFrame,
+) -> pd.DataFrame:
+    # <<<<<<<<<<<<<<<<<<<<<<Schema of input data>>>>>>>>>>>>>>>>>>>>>>
+    # date_block_num, shop_id, item_id, item_price, item_cnt_day
+    # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+
+    # Split record to general and refund sales, zero sales belongs to neither
+    item_cnt_day = input_data["item_cnt_day"].to_numpy(dtype=np.float64)
+    item_price = input_data["item_price"].to_numpy(dtype=np.float64)
+    general_flag = item_cnt_day > 0
+    refund_flag = item_cnt_day < 0
+
+    sales_key = _encode_sales_key(
+        input_data["date_block_num"].to_numpy(),
+        input_data["shop_id"].to_numpy(),
+        input_data["item_id"].to_numpy(),
+    )
+
+    # <<<<<<<<<<<<<<<<<<<<<<Schema of output data>>>>>>>>>>>>>>>>>>>>>>>
+    # index: 'sales_key'
+    # 'general_record_count', 'general_sales_count', 'general_price_sum',
+    # 'refund_record_count', 'refund_sales_count'
+    # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+    return _reduce_by_key(
+        sales_key,
+        {
+            "general_record_count": general_flag,
+            "general_sales_count": np.where(general_flag, item_cnt_day, 0.0),
+            "general_price_sum": np.where(general_flag, item_price, 0.0),
+            "refund_record_count": refund_flag,
+            "refund_sales_count": np.where(refund_flag, item_cnt_day, 0.0),
+        },
+    )
+
+
+def _merge_partial_monthly_sales(partial_list) -> pd.DataFrame:
+    partial_sales = pd.concat(partial_list)
+    return _reduce_by_key(
+        partial_sales.index.to_numpy(),
+        {col: partial_sales[col].to_numpy() for col in _PARTIAL_SALES_COLUMNS},
+    )
+
+
+def _finalize_monthly_sales(partial_sales: pd.DataFrame) -> pd.DataFrame:
+    # Step 1. Keep item with general sales, then evaluate average price, total sales and record count
+    logger.debug("Evaluate total sales...")
+    partial_sales = partial_sales.loc[partial_sales["general_record_count"] > 0]
+    total_sales = partial_sales["general_sales_count"] + partial_sales["refund_sales_count"]
+
+    # Step 2. Remove non-positive sales value
+    partial_sales = partial_sales.loc[total_sales > 0]
+    total_sales = total_sales.loc[total_sales > 0]
+
+    # Step 3. Decode key and compose output columns
+    agg_sales = _decode_sales_key(partial_sales.index.to_numpy())
+    agg_sales["avg_sales_price"] = (
+        partial_sales["general_price_sum"].to_numpy()
+        / partial_sales["general_record_count"].to_numpy()
+    )
+    agg_sales["total_sales"] = total_sales.to_numpy()
+    agg_sales["total_record_count"] = (
+        partial_sales["general_record_count"].to_numpy()
+        + partial_sales["refund_record_count"].to_numpy()
+    )
+
+    data_validator.validate(
+        agg_sales,
+        "integrate_monthly_sales",
+        {"avg_sales_price": (0.0, np.inf), "total_sales": (0.0, np.inf)},
+    )
+
+    # <<<<<<<<<<<<<<<<<<<<<<Schema of output data>>>>>>>>>>>>>>>>>>>>>>>
+    # 'date_block_num', 'shop_id', 'item_id',
+    # 'avg_sales_price',
+    # 'total_sales',
+    # 'total_record_count'
+    # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+    return agg_sales
+
+
+def integrate_monthly_sales(
+    input_data: pd.DataFrame,
+) -> pd.DataFrame:
+    """Aggregate daily sales to monthly sales of each (date_block_num, shop_id, item_id)
+
+    (date_block_num, shop_id, item_id) is encoded to a single integer key, then
+    sales, refunds, record counts and price of positive sales are summed in one
+    sort-and-bincount pass. Output is sorted by key, as integrate_monthly_sales_old.
+    """
+    # <<<<<<<<<<<<<<<<<<<<<<Schema of input data>>>>>>>>>>>>>>>>>>>>>>
+    # date, date_block_num, shop_id, item_id, item_price, item_cnt_day
+    # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+    logger.debug("Aggregation for general and refund sales...")
+    return _finalize_monthly_sales(_partial_monthly_sales(input_data))
+
+
+def integrate_monthly_sales_chunked(
+    filename: str,
+    chunk_size: int = 500000,
+    compact_size: int = 2000000,
+) -> pd.DataFrame:
+    """Aggregate raw daily sales file to monthly sales with bounded memory
+
+    Raw file is consumed chunk by chunk, only running sums and counts per
+    (date_block_num, shop_id, item_id) are kept in memory.
+
+    Args:
+        filename (str): path of raw sales file, e.g. ./dataset/sales_train.csv
+        chunk_size (int, optional): number of raw records of each chunk
+        compact_size (int, optional): merge pending partial results once they exceed this row count
+    """
+    # Accumulate partial sums of each chunk
+    running_sales: pd.DataFrame = None
+    pending_list = []
+    pending_length = 0
+    for chunk_id, chunk in enumerate(
+        csvIO.iter_csv_with_schema(
+            filename,
+            ["date_block_num", "shop_id", "item_id", "item_price", "item_cnt_day"],
+            chunk_size,
+        )
+    ):
+        logger.debug(f"Aggregate chunk {chunk_id}, length: {len(chunk)}")
+        partial_sales = _partial_monthly_sales(chunk)
+        pending_list.append(partial_sales)
+        pending_length += len(partial_sales)
+
+        # Merge pending partial results into running sums
+        if pending_length > compact_size:
+            if running_sales is not None:
+                pending_list.append(running_sales)
+            running_sales = _merge_partial_monthly_sales(pending_list)
+            pending_list = []
+            pending_length = 0
+
+    if running_sales is not None:
+        pending_list.append(running_sales)
+    assert len(pending_list) > 0, "No sales record found in raw file"
+
+    return _finalize_monthly_sales(_merge_partial_monthly_sales(pending_list))
+
+
+def append_monthly_sales(
+    agg_sales_data: pd.DataFrame,
+    new_month_data: pd.DataFrame,
+    item_data: pd.DataFrame = None,
+) -> pd.DataFrame:
+    """Append raw sales of new months to an existing monthly sales table
+
+    Only the raw records of new months are aggregated.
+
+    Args:
+        agg_sales_data (pd.DataFrame): existing output of integrate_monthly_sales (optionally joined category)
+        new_month_data (pd.DataFrame): raw daily sales of new months only
+        item_data (pd.DataFrame, optional): item information, necessary if agg_sales_data has item_category_id
+    """
+    new_month_list = new_month_data["date_block_num"].unique()
+    assert not agg_sales_data["date_block_num"].isin(new_month_list).any(), "Month to be appended already exists in monthly sales"
+    assert new_month_list.min() > agg_sales_data["date_block_num"].max(), "Only months after existing data can be appended"
+
+    # Aggregate new months, then join category information if necessary
+    new_agg_sales = integrate_monthly_sales(new_month_data)
+    if "item_category_id" in agg_sales_data.columns:
+        new_agg_sales = join_category_info(new_agg_sales, item_data)
+
+    return pd.concat(
+        [agg_sales_data, new_agg_sales[agg_sales_data.columns]],
+        ignore_index=True,
+    )
+
+
 def join_category_info(
     input_data: pd.DataFrame,
     item_data: pd.DataFrame
@@ -120,13 +350,69 @@ def join_category_info(
     return input_data.join(item_category_map, on="item_id")
 
 
+# Join engines of feature_join, "merge" (hash merge) or "index" (dense key arrays)
+FEATURE_JOIN_ENGINES = ("merge", "index")
+
+# Key columns of cat-shop, monthly item and monthly item category heat, in join order
+_HEAT_JOIN_KEYS = [
+    ['date_block_num', 'shop_id', 'item_category_id'],
+    ['date_block_num', 'item_id'],
+    ['date_block_num', 'item_category_id'],
+]
+
+
+def _index_join_columns(
+    input_data: pd.DataFrame,
+    heat_feature: pd.DataFrame,
+    keys: List[str],
+) -> Iterator[Tuple[str, np.ndarray]]:
+    # Yield non-key columns of heat_feature at keys of input rows, NaN if the key is absent
+    heat_key_np = [heat_feature[key].to_numpy(dtype=np.int64) for key in keys]
+    input_key_np = [input_data[key].to_numpy(dtype=np.int64) for key in keys]
+    assert all(key.min(initial=0) >= 0 for key in heat_key_np + input_key_np), f"Negative value in keys {keys}"
+
+    # Row position of each key tuple in heat_feature, a 3-D or 2-D array indexed by key values
+    shape = tuple(
+        int(max(heat_key.max(initial=-1), input_key.max(initial=-1))) + 1
+        for heat_key, input_key in zip(heat_key_np, input_key_np)
+    )
+    row_position = np.full(shape, -1, dtype=np.int32 if len(heat_feature) < 2 ** 31 else np.int64)
+    row_position[tuple(heat_key_np)] = np.arange(len(heat_feature))
+    assert (row_position >= 0).sum() == len(heat_feature), f"Duplicated {keys} in heat feature"
+
+    source_row = row_position[tuple(input_key_np)]
+    found_flag = source_row >= 0
+    for col in heat_feature.columns:
+        if col in keys:
+            continue
+        column_np = heat_feature[col].to_numpy()
+        if found_flag.all():
+            yield col, column_np[source_row]
+            continue
+
+        # Unmatched key is NaN, merge turns column with missing value into float
+        join_dtype = column_np.dtype if np.issubdtype(column_np.dtype, np.floating) else np.float64
+        join_np = np.full(len(source_row), np.nan, dtype=join_dtype)
+        join_np[found_flag] = column_np[source_row[found_flag]]
+        yield col, join_np
+
+
 def feature_join(
     input_data: pd.DataFrame,
     cat_shop_sales_heat_feature: pd.DataFrame,
     monthly_item_heat_feature: pd.DataFrame,
     monthly_item_cat_heat_feature: pd.DataFrame,
     drop_column: bool = True,
+    engine: str = "index",
 ) -> pd.DataFrame:
+    """Left join cat-shop, monthly item and monthly item category heat to monthly data
+
+    With engine "index", row position of each heat table is stored in a
+    dense array indexed by its keys, all keys being small non-negative
+    integers, and heat columns are gathered by fancy indexing into one
+    output frame. Columns, their order and dtypes are the same as the
+    "merge" engine, which merges three times.
+    """
     # <<<<<<<<<<<<<<<<<<<<< Schema of input data >>>>>>>>>>>>>>>>>>>>>>
     # 'date_block_num', 'shop_id', 'item_id', 'item_category_id',
     # 'avg_sales_price',
@@ -159,6 +445,22 @@ def feature_join(
     #         inplace=True
     #     )
 
+    assert engine in FEATURE_JOIN_ENGINES, f"Unknown join engine: {engine}"
+    if engine == "index":
+        output_dict = {col: input_data[col].to_numpy() for col in input_data.columns}
+        for heat_feature, keys in zip(
+            [cat_shop_sales_heat_feature, monthly_item_heat_feature, monthly_item_cat_heat_feature],
+            _HEAT_JOIN_KEYS,
+        ):
+            for col, join_np in _index_join_columns(input_data, heat_feature, keys):
+                assert col not in output_dict, f"Column {col} of heat feature already exists"
+                output_dict[col] = join_np
+        output_data = pd.DataFrame(output_dict)
+
+        # Check NaN of unmatched keys and other invalid value of all joined features at once
+        data_validator.validate(output_data, "feature_join")
+        return output_data
+
     # Join Sales Heat Feature
     output_data = (
         input_data.merge(
@@ -176,7 +478,6 @@ def feature_join(
             how='left',
         )
     )
-    assert not output_data.isna().values.any(), "Output value contains NaN after merging feature"
 
     # Join Month Item Feature
     output_data = (
@@ -193,7 +494,6 @@ def feature_join(
             how='left',
         )
     )
-    assert not output_data.isna().values.any(), "Output value contains NaN after merging feature"
 
     # Join Month Item Category Feature
     output_data = (
@@ -210,7 +510,9 @@ def feature_join(
             how='left',
         )
     )
-    assert not output_data.isna().values.any(), "Output value contains NaN after merging feature"
+
+    # Check NaN of unmatched keys and other invalid value of all joined features at once
+    data_validator.validate(output_data, "feature_join")
 
     # Drop duplicated data
     # output_data.drop_duplicates(
@@ -230,7 +532,7 @@ def feature_join(
     return output_data
 
 
-def encode_time_series_data(
+def encode_time_series_data_old(
     input_data: pd.DataFrame,
     month_count: int = 12,
     base_month: int = 0,            # Fetch Data Started From 2013-01 (Default)
@@ -245,17 +547,20 @@ def encode_time_series_data(
 
     # Filter months which is not able to generate complete time series data
     if base_month > month_count:
-        output_ts_data = input_data.query(f"date_block_num >= {base_month}")
+        output_ts_data = input_data.loc[input_data["date_block_num"] >= base_month]
     else:
-        output_ts_data = input_data.query(f"date_block_num >= {month_count}")
+        output_ts_data = input_data.loc[input_data["date_block_num"] >= month_count]
+
+    # Sort by month once, history before a month is a contiguous slice
+    month_index = PartitionIndex(input_data, ["date_block_num"])
 
     # Join historical sales information - join data i-th month ago
     for i in range(1, month_count + 1):
         # if month_count > base_month:
         #     last_i_month_info = input_data.query(f"date_block_num <= {33 - i} and date_block_num >= {base_month - month_count}")
         # else:
-        last_i_month_info = input_data.query(f"date_block_num <= {33 - i}")
-        last_i_month_info["date_block_num"] = last_i_month_info["date_block_num"].apply(lambda x: x + i)   # shift date_block_num
+        last_i_month_info = month_index.range_slice(ub_key=(33 - i,)).copy()
+        last_i_month_info["date_block_num"] = last_i_month_info["date_block_num"] + i   # shift date_block_num
 
         output_ts_data = (
             output_ts_data.merge(
@@ -307,7 +612,352 @@ def encode_time_series_data(
 
     return output_ts_data
 
+# Keys of time series join, history of a key is looked up i months ago
+_TS_KEY_COLUMNS = ['date_block_num', 'shop_id', 'item_id', 'item_category_id']
+
+# Lagged columns dropped except for lag 1, and the extra columns dropped at lag 12 and 24
+_TS_SPARSE_LAG_DROP_COLUMNS = [
+    'total_sales',
+    'avg_sales_price',
+    'cat_shop_sales_heat',
+    'monthly_total_item_sales_heat',
+    'monthly_total_item_cat_sales_heat',
+]
+_TS_SEASONAL_LAG_DROP_COLUMNS = ['avg_sales_price']
+
+
+class LagSpec(NamedTuple):
+    """Lags of each feature joined as time series data
+
+    Lag i of a feature is named {feature}_p{i}. Output starts from month_count,
+    the first month with complete history, which is the largest lag if None.
+    """
+    lags: Dict[str, Tuple[int, ...]]
+    month_count: int = None
+
+    @property
+    def first_month(self) -> int:
+        if self.month_count is not None:
+            return self.month_count
+        return max([max(lag_list) for lag_list in self.lags.values() if len(lag_list)], default=0)
+
+    def columns(self, feature_order: List[str] = None) -> List[str]:
+        """Names of lagged columns, ordered by lag, then by feature_order (spec order if None)"""
+        if feature_order is None:
+            feature_order = list(self.lags.keys())
+        feature_order = [feature for feature in feature_order if feature in self.lags]
+        lag_set = sorted({lag for lag_list in self.lags.values() for lag in lag_list})
+        return [
+            f"{feature}_p{lag}"
+            for lag in lag_set
+            for feature in feature_order
+            if lag in self.lags[feature]
+        ]
+
+    def to_dict(self) -> Dict:
+        """Serializable form, stored in model metadata"""
+        return {
+            "month_count": self.first_month,
+            "lags": {feature: list(lag_list) for feature, lag_list in self.lags.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, spec_dict: Dict):
+        return cls(
+            {feature: tuple(lag_list) for feature, lag_list in spec_dict["lags"].items()},
+            spec_dict.get("month_count"),
+        )
+
+    @classmethod
+    def legacy(cls, value_columns: List[str], month_count: int):
+        """Spec of encode_time_series_data_old, all of lag 1, most of lag 12 and 24 and untracked columns of other lags"""
+        lag_dict = {}
+        for col in value_columns:
+            lag_dict[col] = tuple(
+                lag for lag in range(1, month_count + 1)
+                if lag == 1
+                or ((lag == 12 or lag == 24) and col not in _TS_SEASONAL_LAG_DROP_COLUMNS)
+                or (lag != 12 and lag != 24 and col not in _TS_SPARSE_LAG_DROP_COLUMNS)
+            )
+        return cls(lag_dict, month_count)
+
+
+# Lags used by trainer and inference
+DEFAULT_LAG_SPEC = LagSpec(
+    {
+        'avg_sales_price': (1,),
+        'total_sales': (1, 12, 24),
+        'cat_shop_sales_heat': (1, 12, 24),
+        'monthly_total_item_sales_heat': (1, 12, 24),
+        'monthly_total_item_cat_sales_heat': (1, 12, 24),
+    },
+    24,
+)
+
+
+def _lag_row_position(
+    history_data: pd.DataFrame,
+    history_code: np.ndarray,
+    key_count: int,
+    month_size: int,
+) -> np.ndarray:
+    # Row position of each (key, month) in history, -1 if absent
+    history_month = history_data["date_block_num"].to_numpy(dtype=np.int64)
+    row_position = np.full((key_count, month_size), -1, dtype=np.int32 if len(history_data) < 2 ** 31 else np.int64)
+    row_position[history_code, history_month] = np.arange(len(history_data))
+    assert (row_position >= 0).sum() == len(history_data), "Duplicated (date_block_num, shop_id, item_id, item_category_id) in history data"
+    return row_position
+
+
+def _gather_lag_columns(
+    history_data: pd.DataFrame,
+    history_code: np.ndarray,
+    target_code: np.ndarray,
+    target_month: np.ndarray,
+    lag_spec: LagSpec,
+    last_month: int,
+    row_position: np.ndarray = None,
+) -> Iterator[Tuple[str, np.ndarray]]:
+    # Yield requested (feature, lag) columns of target rows, gathered from history rows with the same key code
+    missing_feature = [feature for feature in lag_spec.lags if feature not in history_data.columns]
+    assert len(missing_feature) == 0, f"Lagged features not in history data: {missing_feature}"
+
+    # Position table can be shared by calls with the same history, e.g. shards of one input
+    if row_position is None:
+        history_month = history_data["date_block_num"].to_numpy(dtype=np.int64)
+        row_position = _lag_row_position(
+            history_data,
+            history_code,
+            int(max(history_code.max(initial=-1), target_code.max(initial=-1))) + 1,
+            int(max(history_month.max(initial=-1), target_month.max(initial=-1))) + 1,
+        )
+
+    lag_dict = {}
+    for col in lag_spec.columns([col for col in history_data.columns if col in lag_spec.lags]):
+        feature, lag = col.rsplit("_p", 1)
+        lag = int(lag)
+
+        # Locate history row of lag months ago once for all features of the lag
+        if lag not in lag_dict:
+            source_month = target_month - lag
+            valid_flag = (source_month >= 0) & (source_month <= last_month - lag)
+            source_row = np.full(len(target_month), -1, dtype=np.int64)
+            source_row[valid_flag] = row_position[target_code[valid_flag], source_month[valid_flag]]
+            lag_dict[lag] = source_row
+        source_row = lag_dict[lag]
+        found_flag = source_row >= 0
+
+        column_np = history_data[feature].to_numpy()
+        if found_flag.all():
+            yield col, column_np[source_row]
+            continue
+
+        # Missing history is 0, merge turns column with missing value into float
+        lag_dtype = column_np.dtype if np.issubdtype(column_np.dtype, np.floating) else np.float64
+        lag_np = np.zeros(len(target_month), dtype=lag_dtype)
+        lag_np[found_flag] = column_np[source_row[found_flag]]
+        yield col, lag_np
+
+
+def encode_time_series_data(
+    input_data: pd.DataFrame,
+    month_count: int = 12,
+    base_month: int = 0,            # Fetch Data Started From 2013-01 (Default)
+    lag_spec: LagSpec = None,
+) -> pd.DataFrame:
+    """Join history of the same (shop_id, item_id, item_category_id) months ago as lagged columns
+
+    Keys are factorized once into a (key, month) row position table, history
+    i months ago is gathered by indexing the table at month - i, only the
+    (feature, lag) pairs of lag_spec are gathered, and the output frame is
+    built once. History is limited to months up to 33 - i and missing history
+    is filled with 0. Without lag_spec, output is the same as
+    encode_time_series_data_old, except that columns of an empty output
+    always follow lag_spec.
+
+    Args:
+        input_data (pd.DataFrame): monthly data with unique (date_block_num, shop_id, item_id, item_category_id)
+        month_count (int, optional): number of lags of legacy spec, used if lag_spec is None
+        base_month (int, optional): first month of output if larger than first month of lag spec
+        lag_spec (LagSpec, optional): lags of each feature
+    """
+    # <<<<<<<<<<<<<<<<<<<Input Data Schema>>>>>>>>>>>>>>>>>>>
+    # date_block_num, shop_id, item_id, item_category_id
+    # avg_sales_price, total_sales, total_record_count,
+    # 'total_record_count',
+    # 'cat_shop_sales_heat',
+    # 'monthly_total_item_sales_heat',
+    # <<<<<<<<<<<<<<<<<<<<<<<<<<>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+    if lag_spec is None:
+        lag_spec = LagSpec.legacy(
+            [col for col in input_data.columns if col not in _TS_KEY_COLUMNS],
+            month_count,
+        )
+
+    # Step 1. Select output rows, months which is not able to generate complete time series data are filtered
+    month_np = input_data["date_block_num"].to_numpy(dtype=np.int64)
+    first_month = base_month if base_month > lag_spec.first_month else lag_spec.first_month
+    output_row = np.flatnonzero(month_np >= first_month)
+
+    # Step 2. Factorize keys, output rows are a subset of history rows
+    key_code = input_data.groupby(_TS_KEY_COLUMNS[1:], sort=False).ngroup().to_numpy()
+    output_dict = {
+        col: input_data[col].to_numpy()[output_row]
+        for col in input_data.columns
+    }
+
+    # Step 3. Gather requested lags by index arithmetic
+    output_dict.update(
+        _gather_lag_columns(
+            input_data,
+            key_code,
+            key_code[output_row],
+            month_np[output_row],
+            lag_spec,
+            33,
+        )
+    )
+
+    # Step 4. Materialize output once, replace NaN with 0
+    output_ts_data = pd.DataFrame(output_dict)
+    return output_ts_data.fillna(0)
+
+
+def iter_time_series_data(
+    input_data: pd.DataFrame,
+    month_count: int = 12,
+    base_month: int = 0,
+    lag_spec: LagSpec = None,
+    shard_by: str = "date_block_num",
+) -> Iterator[Tuple[int, np.ndarray, pd.DataFrame]]:
+    """Encode time series data shard by shard, only one shard of lagged columns is in memory
+
+    Rows of each shard are the rows of encode_time_series_data with the same
+    shard_by value, in input order. Key table and (key, month) row position
+    table are built once for all shards. Lagged columns are float in every
+    shard, so all shards share the same schema.
+
+    Args:
+        input_data (pd.DataFrame): monthly data with unique (date_block_num, shop_id, item_id, item_category_id)
+        month_count (int, optional): number of lags of legacy spec, used if lag_spec is None
+        base_month (int, optional): first month of output if larger than first month of lag spec
+        lag_spec (LagSpec, optional): lags of each feature
+        shard_by (str, optional): column splitting shards, e.g. date_block_num or shop_id
+
+    Yields:
+        Tuple[int, np.ndarray, pd.DataFrame]: shard key, positions of shard rows in input_data and encoded shard
+    """
+    if lag_spec is None:
+        lag_spec = LagSpec.legacy(
+            [col for col in input_data.columns if col not in _TS_KEY_COLUMNS],
+            month_count,
+        )
+
+    # Step 1. Select output rows and split them by shard key
+    month_np = input_data["date_block_num"].to_numpy(dtype=np.int64)
+    first_month = base_month if base_month > lag_spec.first_month else lag_spec.first_month
+    output_row = np.flatnonzero(month_np >= first_month)
+    shard_np = input_data[shard_by].to_numpy()[output_row]
+    shard_order = np.argsort(shard_np, kind="mergesort")
+    shard_list, shard_offset = np.unique(shard_np[shard_order], return_index=True)
+    shard_bound = np.append(shard_offset, len(shard_order))
+
+    # Step 2. Factorize keys and locate history rows once
+    key_code = input_data.groupby(_TS_KEY_COLUMNS[1:], sort=False).ngroup().to_numpy()
+    row_position = _lag_row_position(
+        input_data,
+        key_code,
+        int(key_code.max(initial=-1)) + 1,
+        int(month_np.max(initial=-1)) + 1,
+    )
+
+    # Step 3. Gather requested lags of each shard, then release it before the next one
+    for it, shard_key in enumerate(shard_list):
+        shard_row = output_row[shard_order[shard_bound[it]:shard_bound[it + 1]]]
+        shard_dict = {
+            col: input_data[col].to_numpy()[shard_row]
+            for col in input_data.columns
+        }
+        for col, lag_np in _gather_lag_columns(
+            input_data,
+            key_code,
+            key_code[shard_row],
+            month_np[shard_row],
+            lag_spec,
+            33,
+            row_position,
+        ):
+            shard_dict[col] = lag_np if np.issubdtype(lag_np.dtype, np.floating) else lag_np.astype(np.float64)
+
+        yield shard_key.item(), shard_row, pd.DataFrame(shard_dict).fillna(0)
+
+
+def encode_inference_ts_data(
+    inference_data: pd.DataFrame,
+    history_data: pd.DataFrame,
+    lag_spec: LagSpec,
+    inf_date_block_num: int = 34,   # 2015-11
+) -> pd.DataFrame:
+    """Join lagged history to inference rows with the same lag spec as training
+
+    Args:
+        inference_data (pd.DataFrame): rows to be predicted with shop_id, item_id and item_category_id
+        history_data (pd.DataFrame): monthly data before inf_date_block_num, keys comparable with inference_data
+        lag_spec (LagSpec): lags of each feature, e.g. stored in model metadata
+        inf_date_block_num (int, optional): month to be predicted
+
+    Returns:
+        pd.DataFrame: inference_data with date_block_num and lagged columns, missing history is 0
+    """
+    # Factorize keys of history and inference rows together
+    key_data = pd.concat(
+        [history_data[_TS_KEY_COLUMNS[1:]], inference_data[_TS_KEY_COLUMNS[1:]]],
+        ignore_index=True,
+    )
+    key_code = key_data.groupby(_TS_KEY_COLUMNS[1:], sort=False).ngroup().to_numpy()
+
+    output_ts_data = inference_data.reset_index(drop=True)
+    output_ts_data["date_block_num"] = inf_date_block_num
+    lag_data = pd.DataFrame(
+        dict(
+            _gather_lag_columns(
+                history_data,
+                key_code[:len(history_data)],
+                key_code[len(history_data):],
+                np.full(len(inference_data), inf_date_block_num, dtype=np.int64),
+                lag_spec,
+                inf_date_block_num,
+            )
+        )
+    )
+    return pd.concat([output_ts_data, lag_data], axis=1).fillna(0)
+
+
 def make_inference_ts_data(
+    inference_data: pd.DataFrame,
+    lag_feature_store,
+    inf_date_block_num: int = 34,   # 2015-11
+) -> pd.DataFrame:
+    """Gather lagged columns of inference rows from a LagFeatureStore, sales history is not read
+
+    Args:
+        inference_data (pd.DataFrame): rows to be predicted with original shop_id and item_id
+        lag_feature_store (LagFeatureStore): lagged columns persisted at the end of training
+        inf_date_block_num (int, optional): month to be predicted, the same as target month of store
+
+    Returns:
+        pd.DataFrame: inference_data with date_block_num and lagged columns, missing history is 0
+    """
+    assert lag_feature_store.target_month == inf_date_block_num, \
+        f"Lag feature store is built for month {lag_feature_store.target_month}, not {inf_date_block_num}"
+
+    output_ts_data = inference_data.reset_index(drop=True)
+    output_ts_data["date_block_num"] = inf_date_block_num
+    lag_data = lag_feature_store.gather(output_ts_data)
+    return pd.concat([output_ts_data, lag_data], axis=1)
+
+
+def make_inference_ts_data_old(
     infernece_data: pd.DataFrame,
     monthly_sales_info: pd.DataFrame,
     month_count: int = 12,          # Last 12 Month Data3
@@ -17,45 +17,39 @@ def feature_extract(monthly_sales_train: pd.DataFrame):
     category_count = 84
     shop_count = 60
 
-    logger.info("Statistical average sales with month and item...")
-    item_month_avg_sales = sales_feature.evaluate_mean(
-        monthly_sales_train,
-        ["date_block_num", "item_id"],
-        ["item_cnt_day"],
+    # Evaluate month ID on a new frame, caller's data is not modified
+    monthly_sales_train = monthly_sales_train.assign(
+        month_id=(monthly_sales_train["date_block_num"] % 12) + 1
     )
-    logger.debug(f"Expected: {month_count * item_count}, Real: {len(item_month_avg_sales)} ({len(item_month_avg_sales) * 100 / (month_count * item_count):.2f}%)")
-    # print(item_month_avg_sales.isnull().values.any())
-    feature_collection["sales_item_month"] = item_month_avg_sales.fillna(0)
 
-    logger.info("Statistical average sales with month and category of item...")
-    category_month_avg_sales = sales_feature.evaluate_mean(
-        monthly_sales_train,
-        ["date_block_num", "item_category_id"],
-        ["item_cnt_day"],
-    )
-    logger.debug(f"Expected: {month_count * category_count}, Real: {len(category_month_avg_sales)} ({len(category_month_avg_sales) * 100 / (month_count * category_count):.2f}%)")
-    # print(category_month_avg_sales.isnull().values.any())
-    feature_collection["sales_category_month"] = category_month_avg_sales.fillna(0)
-
-    logger.info("Statistical average sales with shop and item...")
-    item_shop_avg_sales = sales_feature.evaluate_mean(
+    # Evaluate all average sales in one shared pass
+    logger.info("Statistical average sales with month, shop, item and category of item...")
+    feature_spec = {
+        "sales_item_month": ["month_id", "item_id"],
+        "sales_category_month": ["month_id", "item_category_id"],
+        "sales_item_shop": ["shop_id", "item_id"],
+        "sales_category_shop": ["shop_id", "item_category_id"],
+    }
+    avg_sales_collection = sales_feature.grouped_statistics(
         monthly_sales_train,
-        ["shop_id", "item_id"],
-        ["item_cnt_day"],
+        [
+            sales_feature.GroupingSpec(keys, feature_name, "item_cnt_day", ("mean",))
+            for feature_name, keys in feature_spec.items()
+        ],
+        dense=False,
     )
-    logger.debug(f"Expected: {shop_count * item_count}, Real: {len(item_shop_avg_sales)} ({len(item_shop_avg_sales) * 100 / (shop_count * item_count):.2f}%)")
-    # print(item_shop_avg_sales.isnull().values.any())
-    feature_collection["sales_item_shop"] = item_shop_avg_sales.fillna(0)
 
-    logger.info("Statistical average sales with shop and category...")
-    category_shop_avg_sales = sales_feature.evaluate_mean(
-        monthly_sales_train,
-        ["shop_id", "item_category_id"],
-        ["item_cnt_day"],
-    )
-    logger.debug(f"Expected: {shop_count * category_count}, Real: {len(category_shop_avg_sales)} ({len(category_shop_avg_sales) * 100 / (shop_count * category_count):.2f}%)")
-    # print(category_shop_avg_sales.isnull().values.any())
-    feature_collection["sales_category_shop"] = category_shop_avg_sales.fillna(0)
+    expected_length = {
+        "sales_item_month": month_count * item_count,
+        "sales_category_month": month_count * category_count,
+        "sales_item_shop": shop_count * item_count,
+        "sales_category_shop": shop_count * category_count,
+    }
+    for feature_name, avg_sales in avg_sales_collection.items():
+        logger.debug(f"[{feature_name}] Expected: {expected_length[feature_name]}, Real: {len(avg_sales)} ({len(avg_sales) * 100 / expected_length[feature_name]:.2f}%)")
+        feature_collection[feature_name] = avg_sales.rename(
+            columns={f"{feature_name}_mean": "item_cnt_day"}
+        )
 
     return feature_collection
 
@@ -63,8 +57,9 @@ def compose_data(
     data_train: pd.DataFrame,
     feature_collection: Dict["str", pd.DataFrame]
 ):
-    # Copy input data and remove unused columns
-    data_compose = data_train[["date_block_num", "month_id", "shop_id", "item_id", "item_category_id", "item_cnt_day"]]
+    # Copy input data and remove unused columns, month ID is evaluated the same as feature_extract
+    data_compose = data_train[["date_block_num", "shop_id", "item_id", "item_category_id", "item_cnt_day"]]
+    data_compose.insert(1, "month_id", (data_compose["date_block_num"] % 12) + 1)
 
     # print(feature_collection.keys())
 
@@ -0,0 +1,97 @@
+# Provide data quality validation of pipeline stages
+from typing import Dict, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Fraction of rows to be validated if caller does not specify, None for all rows
+DEFAULT_SAMPLE_FRAC: float = None
+
+REPORT_COLUMNS = [
+    "nan_count",
+    "posinf_count",
+    "neginf_count",
+    "below_range_count",
+    "above_range_count",
+]
+
+
+def validate(
+    input_data: pd.DataFrame,
+    stage: str,
+    value_range: Dict[str, Tuple[float, float]] = None,
+    sample_frac: float = None,
+    random_state: int = None,
+) -> pd.DataFrame:
+    """Check all numeric columns for NaN, +inf, -inf and range violation
+
+    Each column is scanned once for non-finite value, only the non-finite
+    elements are classified afterwards. Integer columns can not hold
+    non-finite value and are only checked against value_range.
+
+    Args:
+        input_data (pd.DataFrame): data to be validated
+        stage (str): name of stage, used in log message
+        value_range (Dict[str, Tuple[float, float]], optional): inclusive (min, max) of specific columns
+        sample_frac (float, optional): validate sampled rows only, use DEFAULT_SAMPLE_FRAC if None
+        random_state (int, optional): seed of row sampling
+
+    Returns:
+        pd.DataFrame: count of each violation, indexed by column name
+    """
+    if value_range is None:
+        value_range = {}
+    if sample_frac is None:
+        sample_frac = DEFAULT_SAMPLE_FRAC
+
+    # Sample row position with replacement, which costs no pass over data
+    row_position = None
+    if sample_frac is not None and sample_frac < 1.0:
+        row_position = np.random.default_rng(random_state).integers(
+            0,
+            max(len(input_data), 1),
+            int(np.ceil(len(input_data) * sample_frac)),
+        )
+
+    report_dict = {}
+    for col in input_data.columns:
+        column_np = input_data[col].to_numpy()
+        if not np.issubdtype(column_np.dtype, np.number):
+            continue
+        if row_position is not None and len(column_np) > 0:
+            column_np = column_np[row_position]
+
+        col_report = dict.fromkeys(REPORT_COLUMNS, 0)
+
+        # Non-finite value check
+        if np.issubdtype(column_np.dtype, np.floating):
+            non_finite_np = column_np[~np.isfinite(column_np)]
+            if len(non_finite_np) > 0:
+                col_report["nan_count"] = int(np.isnan(non_finite_np).sum())
+                col_report["posinf_count"] = int(np.isposinf(non_finite_np).sum())
+                col_report["neginf_count"] = int(np.isneginf(non_finite_np).sum())
+
+        # Range check
+        if col in value_range:
+            lb, ub = value_range[col]
+            col_report["below_range_count"] = int((column_np < lb).sum())
+            col_report["above_range_count"] = int((column_np > ub).sum())
+
+        report_dict[col] = col_report
+
+    report = pd.DataFrame.from_dict(
+        report_dict,
+        orient="index",
+        columns=REPORT_COLUMNS,
+    )
+
+    # Log violated columns only
+    violation = report.loc[report.sum(axis=1) > 0]
+    sample_info = "" if row_position is None else f" (sampled {len(row_position)} rows)"
+    if len(violation) == 0:
+        logger.success(f"[{stage}] No NaN, +inf, -inf or out-of-range value{sample_info}")
+    else:
+        logger.error(f"[{stage}] Found invalid value{sample_info}:\n{violation}")
+
+    return report
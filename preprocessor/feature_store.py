@@ -0,0 +1,185 @@
+# Persist the latest lag vector of each (shop_id, item_id) for inference without sales history
+import os
+import json
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from preprocessor import data_integrator
+
+KEY_COLUMNS = ["shop_id", "item_id", "item_category_id"]
+
+# Store written by trainer and read by inference
+DEFAULT_STORE_DIR = "./output/lag_feature_store"
+
+
+class LagFeatureStore:
+    """Lagged columns of target_month for every (shop_id, item_id) seen in history
+
+    Rows of the store are keyed by original ids, a dense (shop, item) table
+    maps a key to its row, so a request batch is scored by one fancy-index
+    gather per column. Min/max of key columns fitted on training data are
+    kept as well, so ids of a request are normalized the same way as the
+    training data instead of being refitted on the request batch. Hash of
+    the training data of the model served with the store is kept, so that
+    inference can tell whether the store matches the model.
+    """
+
+    def __init__(
+        self,
+        lag_spec: data_integrator.LagSpec,
+        target_month: int,
+        position: np.ndarray,
+        key_dict: Dict[str, np.ndarray],
+        value_dict: Dict[str, np.ndarray],
+        key_range: Dict[str, Tuple[float, float]],
+        train_data_hash: str = None,
+    ):
+        self.lag_spec = lag_spec
+        self.target_month = int(target_month)
+        self.position = position
+        self.key_dict = key_dict
+        self.value_dict = value_dict
+        self.key_range = key_range
+        self.train_data_hash = train_data_hash
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.value_dict.keys())
+
+    def __len__(self) -> int:
+        return len(self.key_dict["shop_id"])
+
+    @classmethod
+    def from_history(
+        cls,
+        history_data: pd.DataFrame,
+        lag_spec: data_integrator.LagSpec,
+        target_month: int = 34,     # 2015-11
+    ):
+        """Build store from monthly training data before target_month
+
+        Args:
+            history_data (pd.DataFrame): normalized monthly data of training with original key columns
+            lag_spec (LagSpec): lags of each feature, the same as training
+            target_month (int, optional): month to be predicted
+        """
+        # Step 1. Keys with any history inside the largest lag
+        max_lag = max([max(lag_list) for lag_list in lag_spec.lags.values() if len(lag_list)], default=0)
+        month_np = history_data["date_block_num"].to_numpy(dtype=np.int64)
+        key_data = (
+            history_data.loc[month_np >= target_month - max_lag, KEY_COLUMNS]
+            .drop_duplicates()
+            .astype(np.int64)
+        )
+        assert not key_data.duplicated(["shop_id", "item_id"]).any(), "Item with more than one category in history data"
+
+        # Step 2. Gather lagged columns of target_month once
+        logger.debug(f"Gather lagged columns of {len(key_data)} keys at month {target_month}")
+        lag_data = data_integrator.encode_inference_ts_data(key_data, history_data, lag_spec, target_month)
+        key_dict = {col: lag_data[col].to_numpy(dtype=np.int64) for col in KEY_COLUMNS}
+        value_dict = {col: lag_data[col].to_numpy() for col in lag_spec.columns(list(history_data.columns))}
+
+        # Step 3. Dense row position of each (shop, item)
+        shop_count = int(key_dict["shop_id"].max(initial=-1)) + 1
+        item_count = int(key_dict["item_id"].max(initial=-1)) + 1
+        position = np.full((shop_count, item_count), -1, dtype=np.int32)
+        position[key_dict["shop_id"], key_dict["item_id"]] = np.arange(len(lag_data))
+
+        # Min/max of key columns, the same as fitted by data_normalizer.train_norm
+        key_range = {
+            col: (float(history_data[col].min()), float(history_data[col].max()))
+            for col in KEY_COLUMNS
+        }
+        return cls(lag_spec, target_month, position, key_dict, value_dict, key_range)
+
+    def lookup(self, shop_id: np.ndarray, item_id: np.ndarray) -> np.ndarray:
+        """Return store row of each (shop_id, item_id), -1 if the key has no history"""
+        shop_id = np.asarray(shop_id, dtype=np.int64)
+        item_id = np.asarray(item_id, dtype=np.int64)
+        valid_flag = (
+            (shop_id >= 0) & (shop_id < self.position.shape[0])
+            & (item_id >= 0) & (item_id < self.position.shape[1])
+        )
+        row_np = np.full(len(shop_id), -1, dtype=np.int64)
+        row_np[valid_flag] = self.position[shop_id[valid_flag], item_id[valid_flag]]
+        return row_np
+
+    def gather(self, request_data: pd.DataFrame) -> pd.DataFrame:
+        """Return lagged columns of each request row, missing history is 0
+
+        Args:
+            request_data (pd.DataFrame): rows to be predicted with original shop_id and item_id
+
+        Returns:
+            pd.DataFrame: lagged columns aligned with request rows (same index)
+        """
+        row_np = self.lookup(request_data["shop_id"].to_numpy(), request_data["item_id"].to_numpy())
+        found_flag = row_np >= 0
+
+        lag_dict = {}
+        for col, value in self.value_dict.items():
+            lag_dtype = value.dtype if np.issubdtype(value.dtype, np.floating) else np.float64
+            lag_dict[col] = np.zeros(len(row_np), dtype=lag_dtype)
+            lag_dict[col][found_flag] = value[row_np[found_flag]]
+        return pd.DataFrame(lag_dict, index=request_data.index)
+
+    def normalize_key(self, request_data: pd.DataFrame) -> pd.DataFrame:
+        """Return key columns of request rows scaled by min/max of training data"""
+        norm_dict = {}
+        for col in KEY_COLUMNS:
+            min_value, max_value = self.key_range[col]
+            scale = max_value - min_value if max_value > min_value else 1.0
+            norm_dict[col] = (request_data[col].to_numpy(dtype=np.float64) - min_value) / scale
+        return pd.DataFrame(norm_dict, index=request_data.index)
+
+    def save(self, store_dir: str, train_data_hash: str = None):
+        """Save store as .npy files, which can be memory-mapped by LagFeatureStore.load
+
+        Args:
+            store_dir (str): directory of store files
+            train_data_hash (str, optional): hash of training data of the model, kept in meta data
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        if train_data_hash is not None:
+            self.train_data_hash = train_data_hash
+
+        np.save(os.path.join(store_dir, "position.npy"), self.position)
+        for col, value in self.key_dict.items():
+            np.save(os.path.join(store_dir, f"{col}.npy"), value)
+        for col, value in self.value_dict.items():
+            np.save(os.path.join(store_dir, f"{col}.npy"), value)
+
+        with open(os.path.join(store_dir, "store_meta.json"), "w") as meta_file:
+            json.dump(
+                {
+                    "lag_spec": self.lag_spec.to_dict(),
+                    "target_month": self.target_month,
+                    "columns": self.columns,
+                    "key_range": {col: list(bound) for col, bound in self.key_range.items()},
+                    "train_data_hash": self.train_data_hash,
+                },
+                meta_file,
+                indent=2,
+            )
+        logger.debug(f"Save lag feature store of {len(self)} keys to {store_dir}")
+
+    @classmethod
+    def load(cls, store_dir: str, use_mmap: bool = True):
+        """Load store saved by LagFeatureStore.save, arrays are memory-mapped read-only if use_mmap is set"""
+        with open(os.path.join(store_dir, "store_meta.json"), "r") as meta_file:
+            store_meta = json.load(meta_file)
+
+        mmap_mode = "r" if use_mmap else None
+        load_npy = lambda name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+        return cls(
+            data_integrator.LagSpec.from_dict(store_meta["lag_spec"]),
+            store_meta["target_month"],
+            load_npy("position"),
+            {col: load_npy(col) for col in KEY_COLUMNS},
+            {col: load_npy(col) for col in store_meta["columns"]},
+            {col: tuple(bound) for col, bound in store_meta["key_range"].items()},
+            store_meta.get("train_data_hash"),
+        )
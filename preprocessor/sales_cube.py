@@ -0,0 +1,228 @@
+# Provide a (month x shop x item) cube representation of monthly sales
+import os
+import json
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse as sp
+from loguru import logger
+
+KEY_COLUMNS = ["date_block_num", "shop_id", "item_id"]
+
+
+def _csr_index_dtype(nnz: int, shape: Tuple[int, int]):
+    # scipy keeps int32 index arrays as-is and downcasts int64 to a private copy when values fit in int32
+    return np.int32 if max(nnz, shape[0], shape[1]) < 2 ** 31 else np.int64
+
+
+def _shared_csr(
+    value_dict: Dict[str, np.ndarray],
+    indices: np.ndarray,
+    indptr: np.ndarray,
+    shape: Tuple[int, int],
+) -> Dict[str, sp.csr_matrix]:
+    # Attach data of each column to one (indices, indptr) structure, check no column holds a copy of it
+    matrix_dict = {
+        col: sp.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+        for col, data in value_dict.items()
+    }
+    for col, matrix in matrix_dict.items():
+        assert np.shares_memory(matrix.indices, indices) and np.shares_memory(matrix.indptr, indptr), \
+            f"Structure of column {col} is copied, index dtype: {indices.dtype}"
+    return matrix_dict
+
+
+class SalesCube:
+    """Monthly sales values indexed by (date_block_num, shop_id, item_id)
+
+    Dense cube keeps one (month, shop, item) array per value column and a
+    boolean mask of cells existing in long format. Sparse cube keeps one CSR
+    matrix per value column with (month * shop) rows and item columns, all
+    columns share the same sparsity structure, so rows of a month form a
+    CSR matrix of that month.
+    """
+
+    def __init__(
+        self,
+        shape: Tuple[int, int, int],
+        value_dict: Dict[str, object],
+        mask: np.ndarray = None,
+    ):
+        self.shape = tuple(int(dim) for dim in shape)
+        self.value_dict = value_dict
+        self.mask = mask
+        self.is_sparse = mask is None
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.value_dict.keys())
+
+    @classmethod
+    def from_long(
+        cls,
+        input_data: pd.DataFrame,
+        value_columns: List[str],
+        shape: Tuple[int, int, int] = None,
+        use_sparse: bool = True,
+        dtype=np.float32,
+    ):
+        """Build cube from long format data with unique (date_block_num, shop_id, item_id)
+
+        Args:
+            input_data (pd.DataFrame): long format data, e.g. output of integrate_monthly_sales
+            value_columns (List[str]): columns to be stored in cube
+            shape (Tuple[int, int, int], optional): (month, shop, item) count, evaluate from data if None
+            use_sparse (bool, optional): store as CSR matrix, otherwise dense array
+            dtype (optional): dtype of stored values
+        """
+        assert len(value_columns) > 0, "At least one value column is necessary"
+        key_np = [input_data[col].to_numpy(dtype=np.int64) for col in KEY_COLUMNS]
+        if shape is None:
+            shape = tuple(int(key.max()) + 1 if len(key) else 0 for key in key_np)
+        month_count, shop_count, item_count = shape
+
+        if not use_sparse:
+            mask = np.zeros(shape, dtype=bool)
+            mask[tuple(key_np)] = True
+            assert mask.sum() == len(input_data), "Duplicated (date_block_num, shop_id, item_id) in input data"
+
+            value_dict = {}
+            for col in value_columns:
+                value_dict[col] = np.zeros(shape, dtype=dtype)
+                value_dict[col][tuple(key_np)] = input_data[col].to_numpy()
+            return cls(shape, value_dict, mask)
+
+        # Sort by (row, item) once, then share indices and indptr between all columns
+        row_np = key_np[0] * shop_count + key_np[1]
+        order = np.lexsort((key_np[2], row_np))
+        row_np = row_np[order]
+        index_dtype = _csr_index_dtype(len(order), (month_count * shop_count, item_count))
+        indices = key_np[2][order].astype(index_dtype)
+        indptr = np.zeros(month_count * shop_count + 1, dtype=index_dtype)
+        np.cumsum(np.bincount(row_np, minlength=month_count * shop_count), out=indptr[1:])
+
+        value_dict = _shared_csr(
+            {col: input_data[col].to_numpy(dtype=dtype)[order] for col in value_columns},
+            indices,
+            indptr,
+            (month_count * shop_count, item_count),
+        )
+        assert value_dict[value_columns[0]].has_canonical_format, "Duplicated (date_block_num, shop_id, item_id) in input data"
+        return cls(shape, value_dict)
+
+    def _row(self, month: int, shop: int) -> int:
+        return month * self.shape[1] + shop
+
+    def get(self, column: str, month: int, shop: int, item: int) -> float:
+        """Query value of a cell, 0 for cell not existing in long format"""
+        if not self.is_sparse:
+            return self.value_dict[column][month, shop, item]
+
+        matrix = self.value_dict[column]
+        row = self._row(month, shop)
+        lb, ub = matrix.indptr[row], matrix.indptr[row + 1]
+        pos = lb + np.searchsorted(matrix.indices[lb:ub], item)
+        if pos < ub and matrix.indices[pos] == item:
+            return matrix.data[pos]
+        return 0.0
+
+    def month_slice(self, column: str, month: int):
+        """Return (shop, item) values of a month, CSR matrix if cube is sparse"""
+        if not self.is_sparse:
+            return self.value_dict[column][month]
+        return self.value_dict[column][self._row(month, 0):self._row(month + 1, 0)]
+
+    def dense(self, column: str) -> np.ndarray:
+        """Return (month, shop, item) array of a column"""
+        if not self.is_sparse:
+            return self.value_dict[column]
+        return self.value_dict[column].toarray().reshape(self.shape)
+
+    def to_long(self, columns: List[str] = None) -> pd.DataFrame:
+        """Convert cube back to long format sorted by (date_block_num, shop_id, item_id)"""
+        if columns is None:
+            columns = self.columns
+
+        if not self.is_sparse:
+            key_np = np.nonzero(self.mask)
+            output_data = pd.DataFrame(
+                {col: key.astype(np.int64) for col, key in zip(KEY_COLUMNS, key_np)}
+            )
+            for col in columns:
+                output_data[col] = self.value_dict[col][key_np]
+            return output_data
+
+        structure = self.value_dict[self.columns[0]]
+        row_np = np.repeat(
+            np.arange(self.shape[0] * self.shape[1], dtype=np.int64),
+            np.diff(structure.indptr),
+        )
+        output_data = pd.DataFrame(
+            {
+                "date_block_num": row_np // self.shape[1],
+                "shop_id": row_np % self.shape[1],
+                "item_id": structure.indices.astype(np.int64),
+            }
+        )
+        for col in columns:
+            output_data[col] = self.value_dict[col].data
+        return output_data
+
+    def save(self, cube_dir: str):
+        """Save cube as .npy files, which can be memory-mapped by SalesCube.load"""
+        os.makedirs(cube_dir, exist_ok=True)
+
+        if not self.is_sparse:
+            np.save(os.path.join(cube_dir, "mask.npy"), self.mask)
+            for col, value in self.value_dict.items():
+                np.save(os.path.join(cube_dir, f"{col}.npy"), value)
+        else:
+            structure = self.value_dict[self.columns[0]]
+            np.save(os.path.join(cube_dir, "indices.npy"), structure.indices)
+            np.save(os.path.join(cube_dir, "indptr.npy"), structure.indptr)
+            for col, value in self.value_dict.items():
+                np.save(os.path.join(cube_dir, f"{col}.npy"), value.data)
+
+        with open(os.path.join(cube_dir, "cube_meta.json"), "w") as meta_file:
+            json.dump(
+                {
+                    "shape": self.shape,
+                    "columns": self.columns,
+                    "is_sparse": self.is_sparse,
+                },
+                meta_file,
+                indent=2,
+            )
+        logger.debug(f"Save sales cube to {cube_dir}")
+
+    @classmethod
+    def load(cls, cube_dir: str, use_mmap: bool = True):
+        """Load cube saved by SalesCube.save, arrays are memory-mapped read-only if use_mmap is set"""
+        with open(os.path.join(cube_dir, "cube_meta.json"), "r") as meta_file:
+            cube_meta = json.load(meta_file)
+
+        mmap_mode = "r" if use_mmap else None
+        load_npy = lambda name: np.load(os.path.join(cube_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+        shape = tuple(cube_meta["shape"])
+
+        if not cube_meta["is_sparse"]:
+            value_dict = {col: load_npy(col) for col in cube_meta["columns"]}
+            return cls(shape, value_dict, load_npy("mask"))
+
+        indices = load_npy("indices")
+        indptr = load_npy("indptr")
+        index_dtype = _csr_index_dtype(len(indices), (shape[0] * shape[1], shape[2]))
+        if indices.dtype != index_dtype or indptr.dtype != index_dtype:
+            # Cube saved with int64 structure, convert once and share the converted copy between columns
+            logger.warning(f"Index dtype of {cube_dir} is {indices.dtype}, save cube again to memory-map its structure")
+            indices = np.asarray(indices, dtype=index_dtype)
+            indptr = np.asarray(indptr, dtype=index_dtype)
+
+        value_dict = _shared_csr(
+            {col: load_npy(col) for col in cube_meta["columns"]},
+            indices,
+            indptr,
+            (shape[0] * shape[1], shape[2]),
+        )
+        return cls(shape, value_dict)
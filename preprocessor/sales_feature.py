@@ -1,11 +1,49 @@
 # Provide a statistical feature of sales with different features
-from typing import List
+import copy
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, NamedTuple, Sequence, Tuple
 
 import numpy as np
 import pandas as pd
 from loguru import logger
 
 
+# Bounded LRU cache of grouped statistics, shared by every caller in the process
+STAT_CACHE_MAX_ENTRY = 64
+_stat_cache: "OrderedDict[Tuple, object]" = OrderedDict()
+
+
+def _frame_fingerprint(input_data: pd.DataFrame, columns: List[str]) -> str:
+    """Evaluate content hash of selected columns, row order and dtypes included"""
+    digest = hashlib.sha1()
+    for col in columns:
+        digest.update(f"{col}:{input_data[col].dtype}".encode())
+        digest.update(pd.util.hash_pandas_object(input_data[col], index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def _cache_lookup(cache_key: Tuple):
+    """Return copy of cached statistic and refresh its recency, None on cache miss"""
+    if cache_key not in _stat_cache:
+        return None
+    _stat_cache.move_to_end(cache_key)
+    return copy.deepcopy(_stat_cache[cache_key])
+
+
+def _cache_store(cache_key: Tuple, stat_res):
+    """Store copy of a statistic, evict least recently used entries beyond capacity"""
+    _stat_cache[cache_key] = copy.deepcopy(stat_res)
+    _stat_cache.move_to_end(cache_key)
+    while len(_stat_cache) > STAT_CACHE_MAX_ENTRY:
+        _stat_cache.popitem(last=False)
+
+
+def clear_stat_cache():
+    """Drop all memoized grouped statistics"""
+    _stat_cache.clear()
+
+
 def evaluate_mean(
     train_data: pd.DataFrame,
     input_param: List[str],
@@ -13,31 +51,207 @@ def evaluate_mean(
 ):
     """Do Statistic on average salse based on different item at each month
 
+    date_block_num in input_param is replaced with month_id (1 ~ 12). Neither
+    train_data nor input_param is modified, and results are memoized by content
+    of the necessary columns, so repeated calls on the same data cost a lookup.
+
     Args:
         train_data (pd.DataFrame): training data for feature extraction
+        input_param (List[str]): group keys
+        output_feature (List[str]): columns to be averaged
     """
-    # Evaluate month ID
-    convert_month_id = lambda x: (x % 12) + 1
-    train_data["month_id"] = train_data["date_block_num"].apply(convert_month_id)
-
     # Replace date_block_num with month_id if this parameter is in columns list
-    for i in range(len(input_param)):
-        if input_param[i] == "date_block_num":
-            input_param[i] = "month_id"
+    group_keys = ["month_id" if key == "date_block_num" else key for key in input_param]
+
+    # month_id is always derived from date_block_num
+    source_columns = list(dict.fromkeys(
+        ["date_block_num" if col == "month_id" else col for col in group_keys + output_feature]
+    ))
+    cache_key = (
+        "evaluate_mean",
+        _frame_fingerprint(train_data, source_columns),
+        tuple(group_keys),
+        tuple(output_feature),
+    )
+    stat_res = _cache_lookup(cache_key)
+    if stat_res is not None:
+        return stat_res
 
-    # Select only necessary columns
-    columns: List[str] = input_param + output_feature
-    train_data_agg: pd.DataFrame = train_data[columns]
+    # Select only necessary columns, evaluate month ID on the selected copy
+    train_data_agg: pd.DataFrame = train_data[source_columns].copy()
+    if "month_id" in group_keys + output_feature:
+        train_data_agg["month_id"] = (train_data_agg["date_block_num"] % 12) + 1
+    train_data_agg = train_data_agg[group_keys + output_feature]
 
     # Do aggregation with item ID and date_block_num
-    stat_res: pd.DataFrame = train_data_agg.groupby(input_param).mean().reset_index()
+    stat_res: pd.DataFrame = train_data_agg.groupby(group_keys).mean().reset_index()
 
     # return final result
+    _cache_store(cache_key, stat_res)
     return stat_res
 
 
+# Size of dense id dimensions in the sample dataset, levels are extended if data exceed them
+SHOP_COUNT = 60
+ITEM_COUNT = 22170
+CATEGORY_COUNT = 84
+
+# Default minimum level values of group keys
+DEFAULT_LEVEL_VALUES = {
+    "date_block_num": range(34),
+    "shop_id": range(SHOP_COUNT),
+    "item_id": range(ITEM_COUNT),
+    "item_category_id": range(CATEGORY_COUNT),
+}
+
+
+class GroupingSpec(NamedTuple):
+    """Specification of a grouped statistic
+
+    Output columns are named {prefix}_{metric}, metric is one of sum, mean and count.
+    """
+    keys: List[str]
+    prefix: str
+    value: str = "total_sales"
+    metrics: Tuple[str, ...] = ("sum", "mean")
+
+
+CAT_SHOP_SALES_SPEC = GroupingSpec(
+    ["date_block_num", "shop_id", "item_category_id"],
+    "cat_shop_total_sales",
+)
+MONTHLY_ITEM_SALES_SPEC = GroupingSpec(
+    ["date_block_num", "item_id"],
+    "monthly_total_item_sales",
+)
+MONTHLY_ITEM_CAT_SALES_SPEC = GroupingSpec(
+    ["date_block_num", "item_category_id"],
+    "monthly_total_item_cat_sales",
+)
+SALES_STATISTIC_SPECS = [
+    CAT_SHOP_SALES_SPEC,
+    MONTHLY_ITEM_SALES_SPEC,
+    MONTHLY_ITEM_CAT_SALES_SPEC,
+]
+
+
+def grouped_statistics(
+    input_data: pd.DataFrame,
+    spec_list: List[GroupingSpec],
+    level_values: Dict[str, Sequence[int]] = None,
+    dense: bool = True,
+    use_cache: bool = True,
+) -> Dict[str, pd.DataFrame]:
+    """Evaluate several grouped statistics in one shared pass
+
+    Each key column is encoded to level position once, each value column is
+    read once, then every spec is reduced with bincount over its flattened key.
+    Results are memoized by content of key and value columns and the arguments.
+
+    Args:
+        input_data (pd.DataFrame): long format data, e.g. aggregated monthly sales
+        spec_list (List[GroupingSpec]): statistics to be evaluated
+        level_values (Dict[str, Sequence[int]], optional): minimum values of key columns,
+            override DEFAULT_LEVEL_VALUES, range of data is used for other keys
+        dense (bool, optional): return every level combination with zero filled, otherwise observed groups only
+        use_cache (bool, optional): look up and store result in the statistic cache
+
+    Returns:
+        Dict[str, pd.DataFrame]: statistic table of each spec keyed by its prefix
+    """
+    if use_cache:
+        used_columns = sorted({col for spec in spec_list for col in list(spec.keys) + [spec.value]})
+        cache_key = (
+            "grouped_statistics",
+            _frame_fingerprint(input_data, used_columns),
+            tuple((tuple(spec.keys), spec.prefix, spec.value, tuple(spec.metrics)) for spec in spec_list),
+            None if level_values is None else tuple(
+                (key, tuple(int(value) for value in level_values[key])) for key in sorted(level_values)
+            ),
+            dense,
+        )
+        stat_dict = _cache_lookup(cache_key)
+        if stat_dict is None:
+            stat_dict = grouped_statistics(input_data, spec_list, level_values, dense, use_cache=False)
+            _cache_store(cache_key, stat_dict)
+        return stat_dict
+
+    level_dict = dict(DEFAULT_LEVEL_VALUES)
+    if level_values is not None:
+        level_dict.update(level_values)
+
+    # Step 1. Encode key columns to level position, levels are extended by values of data
+    code_dict = {}
+    for key in sorted({key for spec in spec_list for key in spec.keys}):
+        key_np = input_data[key].to_numpy(dtype=np.int64)
+        if key not in level_dict:
+            level_dict[key] = range(int(key_np.min()), int(key_np.max()) + 1) if len(key_np) else range(0)
+        elif key in DEFAULT_LEVEL_VALUES and (level_values is None or key not in level_values) and len(key_np):
+            # Dense id grows with the catalog, e.g. items appended after the sample dataset
+            level_dict[key] = range(max(len(level_dict[key]), int(key_np.max()) + 1))
+
+        # Levels are sorted explicitly, values out of levels are appended as extra levels instead of being dropped
+        level_np = np.unique(np.asarray(level_dict[key], dtype=np.int64))
+        code_np = np.searchsorted(level_np, key_np).clip(0, max(len(level_np) - 1, 0))
+        valid_flag = (level_np[code_np] == key_np) if len(level_np) else np.zeros(len(key_np), dtype=bool)
+        if not valid_flag.all():
+            extra_np = np.unique(key_np[~valid_flag])
+            logger.warning(f"Extend levels of {key} by {len(extra_np)} values out of given levels")
+            level_np = np.union1d(level_np, extra_np)
+            code_np = np.searchsorted(level_np, key_np)
+        level_dict[key] = level_np
+        code_dict[key] = code_np
+
+    value_dict = {
+        value: input_data[value].to_numpy(dtype=np.float64)
+        for value in {spec.value for spec in spec_list}
+    }
+
+    # Step 2. Reduce each spec by its flattened key
+    stat_dict = {}
+    for spec in spec_list:
+        dims = tuple(len(level_dict[key]) for key in spec.keys)
+        flat_key = np.ravel_multi_index([code_dict[key] for key in spec.keys], dims)
+        group_count = int(np.prod(dims))
+
+        record_count = np.bincount(flat_key, minlength=group_count)
+        value_sum = np.bincount(flat_key, weights=value_dict[spec.value], minlength=group_count)
+
+        metric_dict = {}
+        for metric in spec.metrics:
+            if metric == "sum":
+                metric_dict[f"{spec.prefix}_sum"] = value_sum
+            elif metric == "mean":
+                metric_dict[f"{spec.prefix}_mean"] = np.divide(
+                    value_sum,
+                    record_count,
+                    out=np.zeros(group_count),
+                    where=record_count > 0,
+                )
+            elif metric == "count":
+                metric_dict[f"{spec.prefix}_count"] = record_count.astype(np.float64)
+            else:
+                raise ValueError(f"Unsupported metric: {metric}")
+
+        # Step 3. Compose output table, group keys are in sorted order
+        group_position = np.arange(group_count) if dense else np.flatnonzero(record_count)
+        stat_table = pd.DataFrame(
+            {
+                key: np.asarray(level_dict[key], dtype=np.int64)[key_code]
+                for key, key_code in zip(spec.keys, np.unravel_index(group_position, dims))
+            }
+        )
+        for col, metric_np in metric_dict.items():
+            stat_table[col] = metric_np[group_position]
+
+        stat_dict[spec.prefix] = stat_table
+
+    return stat_dict
+
+
 def shop_seasonal_sales_of_category(
-    input_data: pd.DataFrame
+    input_data: pd.DataFrame,
+    month_list: List[int] = range(34),
 ):
     # <<<<<<<<<<<<<<<<<<<<<<Schema of input data>>>>>>>>>>>>>>>>>>>>>>>
     # 'date_block_num', 'shop_id', 'item_id', 'item_category_id,
@@ -45,134 +259,33 @@ def shop_seasonal_sales_of_category(
     # 'total_sales',
     # 'total_record_count'
     # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-
-    # Step 1. Do aggregation of input data
-    aggregate_map = {
-        "total_sales": ["sum", "mean"],
-    }
-
-    stat_table: pd.DataFrame = (
-        input_data.groupby(['date_block_num', 'shop_id', 'item_category_id'])
-                  .agg(aggregate_map)
-    )
-
-    # Step 2. Integrate output columns
-    stat_table.columns = stat_table.columns.map('_'.join).str.strip('_')
-
-    # Step 3. Zero Patch
-    logger.debug("Do zero patching...")
-
-    # Collect index to patched
-    index_to_patch = []
-    for i in range(34):
-        for j in range(60):
-            for k in range(84):
-                iter_index = (i, j, k)
-                if not iter_index in stat_table.index:
-                    index_to_patch.append(iter_index)
-    value_to_patch = [[0.0, 0.0] for _ in index_to_patch]
-
-    # Create multi-index object
-    patch_df_index = pd.MultiIndex.from_tuples(
-        index_to_patch,
-        names=[
-            "date_block_num",
-            "shop_id",
-            "item_category_id",
-        ]
-    )
-
-    # Create Dataframe to patched
-    patch_df = pd.DataFrame(
-        data=value_to_patch,
-        index=patch_df_index,
-        columns=["total_sales_sum", "total_sales_mean"],
-    )
-
-    # Merge DataFrame to finish patching
-    stat_table = pd.concat([stat_table, patch_df]).rename(
-        columns={
-            "total_sales_sum": "cat_shop_total_sales_sum",
-            "total_sales_mean": "cat_shop_total_sales_mean",
-        }
-    )
-    logger.debug("Done")
-
-    # Sort data by index, then reset index
-    stat_table.sort_index(inplace=True)
-    stat_table.reset_index(inplace=True)
-
-    return stat_table
+    return grouped_statistics(
+        input_data,
+        [CAT_SHOP_SALES_SPEC],
+        {"date_block_num": month_list},
+    )[CAT_SHOP_SALES_SPEC.prefix]
 
 
-def item_total_sales(input_data: pd.DataFrame):
+def item_total_sales(
+    input_data: pd.DataFrame,
+    month_list: List[int] = range(34),
+):
     # <<<<<<<<<<<<<<<<<<<<<<Schema of input data>>>>>>>>>>>>>>>>>>>>>>>
     # 'date_block_num', 'shop_id', 'item_id',
     # 'avg_sales_price',
     # 'total_sales',
     # 'total_record_count'
     # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
-
-    # Step 1. Do aggregation of input data
-    aggregate_map = {
-        "total_sales": ["sum", "mean"],
-    }
-
-    stat_table: pd.DataFrame = (
-        input_data.groupby(['date_block_num', 'item_id',])
-                  .agg(aggregate_map)
-    )
-
-    # Step 2. Integrate output columns
-    stat_table.columns = stat_table.columns.map('_'.join).str.strip('_')
-
-
-    # Step 3. Zero Patch
-    logger.debug("Do zero patching...")
-
-    # Collect index to patched
-    index_to_patch = []
-    for i in range(34):
-        for j in range(22170):
-                iter_index = (i, j)
-                if not iter_index in stat_table.index:
-                    index_to_patch.append(iter_index)
-    value_to_patch = [[0.0, 0.0] for _ in index_to_patch]
-
-    # Create multi-index object
-    patch_df_index = pd.MultiIndex.from_tuples(
-        index_to_patch,
-        names=[
-            "date_block_num",
-            "item_id",
-        ]
-    )
-
-    # Create Dataframe to patched
-    patch_df = pd.DataFrame(
-        data=value_to_patch,
-        index=patch_df_index,
-        columns=["total_sales_sum", "total_sales_mean"],
-    )
-
-    # Merge DataFrame to finish patching
-    stat_table = pd.concat([stat_table, patch_df]).rename(
-        columns={
-            "total_sales_sum": "monthly_total_item_sales_sum",
-            "total_sales_mean": "monthly_total_item_sales_mean",
-        }
-    )
-    logger.debug("Done")
-
-    # Sort data by index, then reset index
-    stat_table.sort_index(inplace=True)
-    stat_table.reset_index(inplace=True)
-
-    return stat_table
+    return grouped_statistics(
+        input_data,
+        [MONTHLY_ITEM_SALES_SPEC],
+        {"date_block_num": month_list},
+    )[MONTHLY_ITEM_SALES_SPEC.prefix]
 
 
 def item_category_total_sales(
-    input_data: pd.DataFrame
+    input_data: pd.DataFrame,
+    month_list: List[int] = range(34),
 ):
     # <<<<<<<<<<<<<<<<<<<<<<Schema of input data>>>>>>>>>>>>>>>>>>>>>>>
     # 'date_block_num', 'shop_id', 'item_id', 'item_category_id,
@@ -180,63 +293,38 @@ def item_category_total_sales(
     # 'total_sales',
     # 'total_record_count'
     # <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
+    return grouped_statistics(
+        input_data,
+        [MONTHLY_ITEM_CAT_SALES_SPEC],
+        {"date_block_num": month_list},
+    )[MONTHLY_ITEM_CAT_SALES_SPEC.prefix]
 
-    # Step 1. Do aggregation of input data
-    aggregate_map = {
-        "total_sales": ["sum", "mean"],
-    }
 
-    stat_table: pd.DataFrame = (
-        input_data.groupby(['date_block_num', 'item_category_id',])
-                  .agg(aggregate_map)
-    )
+def append_month_statistic(
+    stat_table: pd.DataFrame,
+    new_month_sales: pd.DataFrame,
+    stat_func: Callable[[pd.DataFrame, List[int]], pd.DataFrame],
+) -> pd.DataFrame:
+    """Append statistic of newly aggregated months to an existing statistic table
 
-    # Step 2. Integrate output columns
-    stat_table.columns = stat_table.columns.map('_'.join).str.strip('_')
-
-
-    # Step 3. Zero Patch
-    logger.debug("Do zero patching...")
-
-    # Collect index to patched
-    index_to_patch = []
-    for i in range(34):
-        for j in range(84):
-                iter_index = (i, j)
-                if not iter_index in stat_table.index:
-                    index_to_patch.append(iter_index)
-    value_to_patch = [[0.0, 0.0] for _ in index_to_patch]
-
-    # Create multi-index object
-    patch_df_index = pd.MultiIndex.from_tuples(
-        index_to_patch,
-        names=[
-            "date_block_num",
-            "item_category_id",
-        ]
-    )
+    Statistics are grouped by date_block_num, so only the new months are evaluated.
 
-    # Create Dataframe to patched
-    patch_df = pd.DataFrame(
-        data=value_to_patch,
-        index=patch_df_index,
-        columns=["total_sales_sum", "total_sales_mean"],
-    )
+    Args:
+        stat_table (pd.DataFrame): existing output of stat_func
+        new_month_sales (pd.DataFrame): aggregated sales of new months only
+        stat_func (Callable): one of shop_seasonal_sales_of_category, item_total_sales and item_category_total_sales
+    """
+    new_month_list = sorted(new_month_sales["date_block_num"].unique())
+    assert not stat_table["date_block_num"].isin(new_month_list).any(), "Month to be appended already exists in statistic table"
 
-    # Merge DataFrame to finish patching
-    stat_table = pd.concat([stat_table, patch_df]).rename(
-        columns={
-            "total_sales_sum": "monthly_total_item_cat_sales_sum",
-            "total_sales_mean": "monthly_total_item_cat_sales_mean",
-        }
-    )
-    logger.debug("Done")
+    new_stat_table = stat_func(new_month_sales, new_month_list)
 
-    # Sort data by index, then reset index
-    stat_table.sort_index(inplace=True)
-    stat_table.reset_index(inplace=True)
+    # Months are the first sorting key, so new months are appended at the end
+    return pd.concat(
+        [stat_table, new_stat_table[stat_table.columns]],
+        ignore_index=True,
+    )
 
-    return stat_table
 
 def category_shop(train_data: pd.DataFrame):
     pass
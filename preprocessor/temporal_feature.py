@@ -0,0 +1,114 @@
+# Provide rolling-window and exponentially weighted statistics of past monthly sales
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# Group keys of temporal statistics, keyed by feature prefix
+TEMPORAL_GROUPS: Dict[str, List[str]] = {
+    "shop_item": ["shop_id", "item_id"],
+    "item": ["item_id"],
+    "shop_cat": ["shop_id", "item_category_id"],
+}
+DEFAULT_WINDOWS = (3, 6, 12)
+DEFAULT_ALPHAS = (0.3, 0.7)
+
+
+def _group_code(
+    history_data: pd.DataFrame,
+    target_data: pd.DataFrame,
+    keys: List[str],
+):
+    # Encode key tuples of history and target rows into shared dense group codes
+    encoded_list = []
+    for frame in (history_data, target_data):
+        encoded_key = np.zeros(len(frame), dtype=np.int64)
+        for key in keys:
+            encoded_key = encoded_key * (1 << 20) + frame[key].to_numpy(dtype=np.int64)
+        encoded_list.append(encoded_key)
+
+    _, code_np = np.unique(np.concatenate(encoded_list), return_inverse=True)
+    return code_np[:len(history_data)], code_np[len(history_data):], int(code_np.max()) + 1 if len(code_np) else 0
+
+
+def rolling_feature(
+    history_data: pd.DataFrame,
+    target_data: pd.DataFrame,
+    value_column: str = "total_sales",
+    group_dict: Dict[str, List[str]] = None,
+    windows: Sequence[int] = DEFAULT_WINDOWS,
+    alphas: Sequence[float] = DEFAULT_ALPHAS,
+) -> pd.DataFrame:
+    """Evaluate rolling and EWMA statistics of past months for each target row
+
+    For a target row at month t, window w covers months t-w to t-1 and EWMA
+    is updated with months up to t-1, so the statistics never include the
+    target month itself. Months without record count as zero sales.
+
+    Values of each group are summed into a (group, month) array once; rolling
+    sums come from its cumulative sum, rolling max from w shifted maxima and
+    EWMA from one recursion over months, all vectorized over groups.
+
+    Args:
+        history_data (pd.DataFrame): monthly sales with date_block_num, group keys and value column
+        target_data (pd.DataFrame): rows to evaluate feature for, with date_block_num and group keys
+        value_column (str, optional): column to be summarized
+        group_dict (Dict[str, List[str]], optional): group keys keyed by feature prefix, TEMPORAL_GROUPS if None
+        windows (Sequence[int], optional): rolling window sizes in months
+        alphas (Sequence[float], optional): smoothing factors of EWMA
+
+    Returns:
+        pd.DataFrame: features aligned with rows of target_data (same index)
+    """
+    if group_dict is None:
+        group_dict = TEMPORAL_GROUPS
+
+    target_month = target_data["date_block_num"].to_numpy(dtype=np.int64)
+    month_count = int(target_month.max()) + 1 if len(target_month) else 0
+
+    # Only history before the last target month is necessary
+    history_data = history_data.loc[history_data["date_block_num"] < month_count]
+    history_month = history_data["date_block_num"].to_numpy(dtype=np.int64)
+    history_value = history_data[value_column].to_numpy(dtype=np.float64)
+
+    feature_dict = {}
+    for prefix, keys in group_dict.items():
+        logger.debug(f"Evaluate temporal feature of group: {prefix}")
+        history_code, target_code, group_count = _group_code(history_data, target_data, keys)
+
+        # Step 1. Sum value of each (group, month)
+        month_value = np.bincount(
+            history_code * month_count + history_month,
+            weights=history_value,
+            minlength=group_count * month_count,
+        ).reshape(group_count, month_count).astype(np.float32)
+
+        # Step 2. Cumulative sum with leading zero, value_cumsum[:, t] is sum of months before t
+        value_cumsum = np.zeros((group_count, month_count + 1), dtype=np.float64)
+        np.cumsum(month_value, axis=1, out=value_cumsum[:, 1:])
+
+        # Step 3. Rolling sum, mean and max of each window
+        max_window = max(windows) if len(windows) else 0
+        running_max = np.zeros((group_count, month_count), dtype=np.float32)
+        for shift in range(1, max_window + 1):
+            # running_max[:, t] is max of months t-shift to t-1 after this step
+            np.maximum(running_max[:, shift:], month_value[:, :-shift], out=running_max[:, shift:])
+            if shift not in windows:
+                continue
+
+            lower_month = np.maximum(target_month - shift, 0)
+            window_sum = value_cumsum[target_code, target_month] - value_cumsum[target_code, lower_month]
+            feature_dict[f"{prefix}_{value_column}_roll{shift}_sum"] = window_sum
+            feature_dict[f"{prefix}_{value_column}_roll{shift}_mean"] = window_sum / shift
+            feature_dict[f"{prefix}_{value_column}_roll{shift}_max"] = running_max[target_code, target_month]
+
+        # Step 4. EWMA of past months, value_ewm[:, t] only depends on months before t
+        for alpha in alphas:
+            value_ewm = np.zeros((group_count, month_count), dtype=np.float32)
+            for month in range(1, month_count):
+                value_ewm[:, month] = alpha * month_value[:, month - 1] + (1 - alpha) * value_ewm[:, month - 1]
+            alpha_name = str(alpha).replace(".", "")
+            feature_dict[f"{prefix}_{value_column}_ewm{alpha_name}"] = value_ewm[target_code, target_month]
+
+    return pd.DataFrame(feature_dict, index=target_data.index)
@@ -1,19 +1,46 @@
+import os
+import glob
 import time
 import argparse
 
 from loguru import logger
+import numpy as np
 import pandas as pd
 
-from utils import csvIO, modelIO
+from utils import csvIO, modelIO, cacheIO, shardIO
 from preprocessor import (
     sales_feature,
     data_operation,
     data_integrator,
     data_cleaner,
     data_normalizer,
+    temporal_feature,
+    feature_store,
 )
 from predictor import DTR, XGBoost, kMeans
 
+# Append rolling-window and EWMA statistics of past sales to training data
+USE_TEMPORAL_FEATURE = False
+
+# Lags of each feature in time series data, stored with model for inference
+TS_LAG_SPEC = data_integrator.DEFAULT_LAG_SPEC
+
+# Latest lag vector of each (shop_id, item_id), read by inference instead of sales history
+LAG_FEATURE_STORE_DIR = feature_store.DEFAULT_STORE_DIR
+
+# Directory of month shards of time series data, e.g. "./output/ts_train_shard"
+# Training data is encoded and trained shard by shard out of core if set, otherwise in memory
+TS_SHARD_DIR = None
+
+# Worker processes and base seed of sales heat clustering
+KMEANS_N_JOBS = os.cpu_count() or 1
+KMEANS_RANDOM_STATE = 0
+
+# Clustering engine of sales heat, "sklearn", "dp" (exact 1-D k-means) or "lloyd" (batched)
+KMEANS_ENGINE = "sklearn"
+# Clustering engine of monthly item and item category heat, also accepts "warm" (warm-started month by month)
+KMEANS_MONTHLY_ENGINE = KMEANS_ENGINE
+
 def main_old():
 
     total_month_count = 34
@@ -73,152 +100,363 @@ def main_old():
 
 def main():
 
-#-----------------------------------------------------------------------------------
-# Phase 1. Read Data
-    # a. Read original training data
-    logger.info("Reading dataset, file name: ./dataset/sales_train.csv")
-    original_train_data = csvIO.read_csv_to_pddf("./dataset/sales_train.csv")
-
-    # b. Read item information - including category info
-    logger.info("Reading dataset, file name: ./dataset/items.csv")
-    item_info = csvIO.read_csv_to_pddf("./dataset/train_monthly_sales.csv")
+    # Cache key of raw dataset and feature pipeline source code, stage bodies are defined in this file
+    dataset_key = cacheIO.file_key(
+        "./dataset/sales_train.csv",
+        "./dataset/items.csv",
+    )
+    pipeline_code_key = cacheIO.file_key(
+        *glob.glob("./preprocessor/*.py"),
+        "./predictor/kMeans.py",
+        "./utils/partitionIndex.py",
+        "./utils/csvIO.py",
+        __file__,
+        content=True,
+    )
 
 #-----------------------------------------------------------------------------------
-# Phase 2. Integrate Training Data and Do Feature Extraction
-
-    # a. Integrate train data to monthly information, then join category information
-    logger.info("Aggregate original training data to monthly sales.")
-    agg_sales_train_data = data_integrator.integrate_monthly_sales(original_train_data)
-
-    # b. Join Category Info
-    logger.info("Join category information.")
-    agg_sales_train_data = data_integrator.join_category_info(agg_sales_train_data, item_info)
-
-    # c. Permutate agg_sales_train_data
-    agg_sales_train_data = agg_sales_train_data[
-        ['date_block_num', 'shop_id', 'item_id', 'item_category_id',
-         'avg_sales_price', 'total_sales', 'total_record_count']
-    ]
-
-    # d. Do statistics - Monthly sales of specific category on specific shop
-    logger.info("Do statistics - Monthly sales of specific category on specific shop")
-    category_sales_on_shop_per_month = sales_feature.shop_seasonal_sales_of_category(agg_sales_train_data)
+# Phase 1. Read Data and Integrate Training Data
+
+    def monthly_sales_stage():
+        # a. Read original training data
+        logger.info("Reading dataset, file name: ./dataset/sales_train.csv")
+        original_train_data = csvIO.read_sales_train(
+            "./dataset/sales_train.csv",
+            ["date_block_num", "shop_id", "item_id", "item_price", "item_cnt_day"],
+        )
+
+        # b. Read item information - including category info
+        logger.info("Reading dataset, file name: ./dataset/items.csv")
+        item_info = csvIO.read_csv_with_schema(
+            "./dataset/items.csv",
+            ["item_id", "item_category_id"],
+        )
+
+        # c. Integrate train data to monthly information, then join category information
+        logger.info("Aggregate original training data to monthly sales.")
+        agg_sales_train_data = data_integrator.integrate_monthly_sales(original_train_data)
+
+        # d. Join Category Info
+        logger.info("Join category information.")
+        agg_sales_train_data = data_integrator.join_category_info(agg_sales_train_data, item_info)
+
+        # e. Permutate agg_sales_train_data
+        return agg_sales_train_data[
+            ['date_block_num', 'shop_id', 'item_id', 'item_category_id',
+             'avg_sales_price', 'total_sales', 'total_record_count']
+        ]
+
+    agg_sales_key, agg_sales_train_data = cacheIO.cached_stage(
+        "monthly_sales",
+        [dataset_key, pipeline_code_key],
+        {},
+        monthly_sales_stage,
+    )
 
-    # e. Do statistics - Monthly sales of all item without distinguishing shop
-    logger.info("Do statistics - Monthly sales of all item without distinguishing shop")
-    monthly_total_item_sales = sales_feature.item_total_sales(agg_sales_train_data)
+#-----------------------------------------------------------------------------------
+# Phase 2. Do Feature Extraction
+
+    def sales_statistic_stage():
+        # Do statistics in one shared pass
+        # a. Monthly sales of specific category on specific shop
+        # b. Monthly sales of all item without distinguishing shop
+        # c. Monthly sales of all item category without distinguishing shop
+        logger.info("Do statistics - Monthly sales of category on shop, item and item category")
+        sales_statistic = sales_feature.grouped_statistics(
+            agg_sales_train_data,
+            sales_feature.SALES_STATISTIC_SPECS,
+        )
+
+        return (
+            sales_statistic[sales_feature.CAT_SHOP_SALES_SPEC.prefix],
+            sales_statistic[sales_feature.MONTHLY_ITEM_SALES_SPEC.prefix],
+            sales_statistic[sales_feature.MONTHLY_ITEM_CAT_SALES_SPEC.prefix],
+        )
+
+    sales_statistic_key, (
+        category_sales_on_shop_per_month,
+        monthly_total_item_sales,
+        monthly_total_item_cat_sales,
+    ) = cacheIO.cached_stage(
+        "sales_statistic",
+        [agg_sales_key],
+        {},
+        sales_statistic_stage,
+    )
 
-    logger.info("Do statistics - Monthly sales of all item category without distinguishing shop")
-    monthly_total_item_cat_sales = sales_feature.item_category_total_sales(agg_sales_train_data)
+    # Persist monthly tables for incremental month refresh, see monthly_refresh.py
+    csvIO.write_pd_to_pickle(agg_sales_train_data, "monthly_sales.pkl", background=True)
+    csvIO.write_pd_to_pickle(category_sales_on_shop_per_month, "cat_shop_monthly_sales.pkl", background=True)
+    csvIO.write_pd_to_pickle(monthly_total_item_sales, "monthly_item_sales.pkl", background=True)
+    csvIO.write_pd_to_pickle(monthly_total_item_cat_sales, "monthly_item_cat_sales.pkl", background=True)
 
 #-----------------------------------------------------------------------------------
 # Phase 3. Data Cleaning and Normalization
 
     # a. Clean outlier of training data
-    logger.info("Clean Outliers of Training Data")
-    clean_outlier_train_data = data_cleaner.remove_outlier(agg_sales_train_data)
+    def clean_outlier_stage():
+        logger.info("Clean Outliers of Training Data")
+        return data_cleaner.remove_outlier(agg_sales_train_data)
+
+    clean_outlier_key, clean_outlier_train_data = cacheIO.cached_stage(
+        "clean_outlier",
+        [agg_sales_key],
+        {},
+        clean_outlier_stage,
+    )
 
 #-----------------------------------------------------------------------------------
 # Phase 4. k-Means clustering for extract feature of popularity
-    logger.info("Do sales heat auto clustering")
-    category_heat_value = kMeans.extract_sales_heat(category_sales_on_shop_per_month)
+    def sales_heat_stage():
+        logger.info("Do sales heat auto clustering")
+        category_heat_value = kMeans.extract_sales_heat(
+            category_sales_on_shop_per_month,
+            n_jobs=KMEANS_N_JOBS,
+            random_state=KMEANS_RANDOM_STATE,
+            engine=KMEANS_ENGINE,
+        )
+
+        monthly_item_heat_value = kMeans.extract_monthly_item_sales_heat(
+            monthly_total_item_sales,
+            engine=KMEANS_MONTHLY_ENGINE,
+            random_state=KMEANS_RANDOM_STATE,
+        )
+
+        monthly_item_cat_heat_value = kMeans.extract_monthly_item_cat_sales_heat(
+            monthly_total_item_cat_sales,
+            engine=KMEANS_MONTHLY_ENGINE,
+            random_state=KMEANS_RANDOM_STATE,
+        )
+
+        return (
+            category_heat_value,
+            monthly_item_heat_value,
+            monthly_item_cat_heat_value,
+        )
+
+    sales_heat_key, (
+        category_heat_value,
+        monthly_item_heat_value,
+        monthly_item_cat_heat_value,
+    ) = cacheIO.cached_stage(
+        "sales_heat",
+        [sales_statistic_key],
+        {
+            "random_state": KMEANS_RANDOM_STATE,
+            "engine": KMEANS_ENGINE,
+            "monthly_engine": KMEANS_MONTHLY_ENGINE,
+        },
+        sales_heat_stage,
+    )
+
+    # Heat values are loaded by inference, write them on every run in background
     csvIO.write_pd_to_csv(
         category_heat_value,
         "category_heat_value.csv",
         False,
-    )
-    # category_heat_value = csvIO.read_csv_to_pddf(
-    #     "./output/category_heat_value.csv"
-    # )
-    # print(category_heat_value)
-
-    monthly_item_heat_value = kMeans.extract_monthly_item_sales_heat(
-        monthly_total_item_sales
+        background=True,
     )
     csvIO.write_pd_to_csv(
         monthly_item_heat_value,
         "monthly_item_heat_value.csv",
-        False
-    )
-    # monthly_item_heat_value = csvIO.read_csv_to_pddf(
-    #     "./output/monthly_item_heat_value.csv"
-    # )
-
-    monthly_item_cat_heat_value = kMeans.extract_monthly_item_cat_sales_heat(
-        monthly_total_item_cat_sales
+        False,
+        background=True,
     )
     csvIO.write_pd_to_csv(
         monthly_item_cat_heat_value,
         "monthly_item_cat_heat_value.csv",
-        False
-    )
-    # monthly_item_heat_value = csvIO.read_csv_to_pddf(
-    #     "./output/monthly_item_heat_value.csv"
-    # )
-
-#-----------------------------------------------------------------------------------
-# Phase 5. Do Input Data Normalization
-
-    # Step 1. Integrate features
-    logger.info("Join sales heat feature")
-    train_data_with_feature = data_integrator.feature_join(
-        clean_outlier_train_data,
-        category_heat_value,
-        monthly_item_heat_value,
-        monthly_item_cat_heat_value,
-    )
-    assert len(clean_outlier_train_data) == len(train_data_with_feature), "Inconsistant length of data before/after join operation"
-
-    train_data_with_feature.drop(
-        columns=[
-            'cat_shop_total_sales_sum',
-            'monthly_total_item_sales_sum',
-            'monthly_total_item_cat_sales_sum',
-            'cat_shop_total_sales_mean',
-            'monthly_total_item_sales_mean',
-            'monthly_total_item_cat_sales_mean',
-            # 'avg_sales_price',
-            'total_record_count',
-        ],
-        inplace=True
-    )
-
-    # Step 2. Normalization
-    # logger.info("Data Normalization")
-    norm_train_data = (
-        data_normalizer.train_norm(train_data_with_feature)
+        False,
+        background=True,
     )
-    logger.debug("Use Original value on fitting target - total_sales")
 
-    # Cancel Normalization on Output Data and Specific Columns
-    norm_train_data["date_block_num"] = train_data_with_feature["date_block_num"]
-    norm_train_data["total_sales"] = train_data_with_feature["total_sales"]
-    # norm_train_data = train_data_with_feature
-    print(norm_train_data.columns)
-    # ts_train_data_norm = ts_train_data
+    # Heat thresholds label any sales sum without the full heat tables, see kMeans.assign_heat
+    for heat_name, heat_value in [
+        ("cat_shop", category_heat_value),
+        ("monthly_item", monthly_item_heat_value),
+        ("monthly_item_cat", monthly_item_cat_heat_value),
+    ]:
+        csvIO.write_pd_to_csv(
+            kMeans.heat_threshold_table(heat_value, heat_name),
+            f"{heat_name}_heat_threshold.csv",
+            False,
+            background=True,
+        )
 
 #-----------------------------------------------------------------------------------
-# Phase 6. Encode Time Series Data
-
-    # Step 1. Encode all features as time series data
-    logger.info("Encode Time Series Data")
-    ts_train_data = data_integrator.encode_time_series_data(
-        norm_train_data,
-        24,
-    )
-
-    # Step 2. Do normalization for month ID
-    ts_train_data["date_block_num"] = ts_train_data["date_block_num"].apply(
-        lambda x: (x % 12) - 0 / 11
-    )
-
-    print(len(ts_train_data))
+# Phase 5 & 6. Do Input Data Normalization, then Encode Time Series Data
+
+    def feature_norm_step():
+        # Step 1. Integrate features
+        logger.info("Join sales heat feature")
+        train_data_with_feature = data_integrator.feature_join(
+            clean_outlier_train_data,
+            category_heat_value,
+            monthly_item_heat_value,
+            monthly_item_cat_heat_value,
+        )
+        assert len(clean_outlier_train_data) == len(train_data_with_feature), "Inconsistant length of data before/after join operation"
+
+        train_data_with_feature.drop(
+            columns=[
+                'cat_shop_total_sales_sum',
+                'monthly_total_item_sales_sum',
+                'monthly_total_item_cat_sales_sum',
+                'cat_shop_total_sales_mean',
+                'monthly_total_item_sales_mean',
+                'monthly_total_item_cat_sales_mean',
+                # 'avg_sales_price',
+                'total_record_count',
+            ],
+            inplace=True
+        )
+
+        # Step 2. Normalization
+        # logger.info("Data Normalization")
+        norm_train_data = (
+            data_normalizer.train_norm(train_data_with_feature)
+        )
+        logger.debug("Use Original value on fitting target - total_sales")
+
+        # Cancel Normalization on Output Data and Specific Columns
+        norm_train_data["date_block_num"] = train_data_with_feature["date_block_num"]
+        norm_train_data["total_sales"] = train_data_with_feature["total_sales"]
+        # norm_train_data = train_data_with_feature
+        print(norm_train_data.columns)
+        # ts_train_data_norm = ts_train_data
+
+        # Step 3. Persist latest lag vector of each (shop_id, item_id), history is looked up by original ids
+        logger.info("Build lag feature store for inference")
+        key_columns = feature_store.KEY_COLUMNS
+        history_data = norm_train_data.copy()
+        history_data[key_columns] = train_data_with_feature[key_columns].to_numpy()
+        lag_feature_store = feature_store.LagFeatureStore.from_history(history_data, TS_LAG_SPEC)
+
+        return train_data_with_feature, norm_train_data, lag_feature_store
+
+    def temporal_step(train_data_with_feature):
+        # Step 6. Temporal statistics of rows of months >= first month of lag spec, in the order of encoded data
+        if not USE_TEMPORAL_FEATURE:
+            return None
+
+        logger.info("Evaluate rolling-window and EWMA statistics of past sales")
+        return temporal_feature.rolling_feature(
+            train_data_with_feature,
+            train_data_with_feature.loc[train_data_with_feature["date_block_num"] >= TS_LAG_SPEC.first_month],
+        ).reset_index(drop=True)
+
+    def ts_transform_step(ts_data, temporal_data):
+        # Step 5. Do normalization for month ID
+        ts_data["date_block_num"] = ts_data["date_block_num"].apply(
+            lambda x: (x % 12) - 0 / 11
+        )
+
+        # Append temporal statistics, rows of temporal_data are the rows of encoded data
+        if temporal_data is not None:
+            assert len(temporal_data) == len(ts_data), "Inconsistant length of temporal feature"
+            ts_data = pd.concat(
+                [ts_data, temporal_data.reset_index(drop=True)],
+                axis=1,
+            )
+
+        return ts_data
+
+    def ts_train_data_stage():
+        train_data_with_feature, norm_train_data, lag_feature_store = feature_norm_step()
+
+        # Step 4. Encode all features as time series data
+        logger.info("Encode Time Series Data")
+        ts_train_data = data_integrator.encode_time_series_data(
+            norm_train_data,
+            lag_spec=TS_LAG_SPEC,
+        )
+
+        # Rows of encoded data keep order of months >= first month of lag spec
+        ts_train_data = ts_transform_step(ts_train_data, temporal_step(train_data_with_feature))
+
+        return ts_train_data, lag_feature_store
+
+    def ts_shard_source_stage():
+        train_data_with_feature, norm_train_data, lag_feature_store = feature_norm_step()
+        return norm_train_data, lag_feature_store, temporal_step(train_data_with_feature)
+
+    if TS_SHARD_DIR is None:
+        _, (ts_train_data, lag_feature_store) = cacheIO.cached_stage(
+            "ts_train_data",
+            [clean_outlier_key, sales_heat_key],
+            {"lag_spec": TS_LAG_SPEC.to_dict(), "temporal_feature": USE_TEMPORAL_FEATURE, "lag_feature_store": True},
+            ts_train_data_stage,
+        )
+
+        print(len(ts_train_data))
+    else:
+        # Normalized data, lag feature store and temporal statistics are cached as one stage
+        ts_shard_source_key, (norm_train_data, lag_feature_store, temporal_data) = cacheIO.cached_stage(
+            "ts_shard_source",
+            [clean_outlier_key, sales_heat_key],
+            {"lag_spec": TS_LAG_SPEC.to_dict(), "temporal_feature": USE_TEMPORAL_FEATURE},
+            ts_shard_source_stage,
+        )
+
+        # Encode month by month and write each shard as soon as it is encoded, only one shard is in memory
+        ts_shard_key = cacheIO.stage_key("ts_train_shard", [ts_shard_source_key])
+        if shardIO.shard_source_key(TS_SHARD_DIR) == ts_shard_key:
+            logger.info(f"Time series shards are up to date: {TS_SHARD_DIR}")
+        else:
+            logger.info(f"Encode Time Series Data into month shards: {TS_SHARD_DIR}")
+
+            # Row of temporal statistics of each row of normalized data, -1 for months before first month
+            temporal_row = np.full(len(norm_train_data), -1, dtype=np.int64)
+            temporal_position = np.flatnonzero(norm_train_data["date_block_num"].to_numpy() >= TS_LAG_SPEC.first_month)
+            temporal_row[temporal_position] = np.arange(len(temporal_position))
+
+            shardIO.write_shards(
+                (
+                    (
+                        month,
+                        ts_transform_step(
+                            ts_shard,
+                            None if temporal_data is None else temporal_data.iloc[temporal_row[shard_row]],
+                        ),
+                    )
+                    for month, shard_row, ts_shard in data_integrator.iter_time_series_data(
+                        norm_train_data,
+                        lag_spec=TS_LAG_SPEC,
+                    )
+                ),
+                TS_SHARD_DIR,
+                source_key=ts_shard_key,
+            )
+        ts_shard_reader = shardIO.ShardReader(TS_SHARD_DIR)
+
+        print(ts_shard_reader.row_count)
 
 #-----------------------------------------------------------------------------------
 # Phase 7. XGBoostRegressor Training and Evaluate Performance
     logger.info("Fit XGBoost Regressor")
-    xgbr = XGBoost.train(ts_train_data, 0.20)
-    modelIO.save(xgbr, "xgbr_new_feature")
+    if TS_SHARD_DIR is None:
+        xgbr = XGBoost.train(ts_train_data, 0.20)
+        train_data_hash = modelIO.dataframe_digest(ts_train_data)
+    else:
+        xgbr = XGBoost.train_from_shards(ts_shard_reader, 0.20)
+        train_data_hash = ts_shard_reader.digest()
+    modelIO.save_booster(
+        xgbr,
+        "xgbr_new_feature",
+        {
+            "lag_spec": TS_LAG_SPEC.to_dict(),
+            "train_data_hash": train_data_hash,
+            "temporal_feature": {
+                "windows": list(temporal_feature.DEFAULT_WINDOWS),
+                "alphas": list(temporal_feature.DEFAULT_ALPHAS),
+            } if USE_TEMPORAL_FEATURE else None,
+        },
+    )
+
+    # Store is saved with hash of training data, inference uses it only if it matches the model
+    lag_feature_store.save(LAG_FEATURE_STORE_DIR, train_data_hash)
+
+    # Wait for background writing of artifacts
+    csvIO.flush_writer()
 #-----------------------------------------------------------------------------------
 # Phase 8. Do Inference Based on Training Result
 
@@ -0,0 +1,112 @@
+import os
+import json
+import pickle
+import hashlib
+from typing import Any, Callable, Dict, List, Tuple
+
+from loguru import logger
+
+# Root directory of cached stage artifacts and its capacity
+STAGE_CACHE_DIR = "./cache/stage"
+STAGE_CACHE_MAX_BYTES = 8 * 1024 ** 3
+STAGE_CACHE_MAX_ENTRY = 32
+
+
+def file_key(*filenames: str, content: bool = False) -> str:
+    """Evaluate cache key of files
+
+    Args:
+        filenames (str): paths of files
+        content (bool, optional): hash file content, otherwise use size and modified time only
+    """
+    digest = hashlib.sha1()
+    for filename in sorted(filenames):
+        digest.update(os.path.abspath(filename).encode())
+        if content:
+            with open(filename, "rb") as key_file:
+                digest.update(key_file.read())
+        else:
+            stat = os.stat(filename)
+            digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+    return digest.hexdigest()
+
+
+def stage_key(
+    stage_name: str,
+    upstream_keys: List[str],
+    params: Dict = None,
+) -> str:
+    """Evaluate cache key of a stage by its name, upstream keys and parameters"""
+    key_content = json.dumps(
+        [stage_name, upstream_keys, params],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha1(key_content.encode()).hexdigest()
+
+
+def evict(
+    cache_dir: str = STAGE_CACHE_DIR,
+    max_bytes: int = STAGE_CACHE_MAX_BYTES,
+    max_entry: int = STAGE_CACHE_MAX_ENTRY,
+):
+    """Remove least recently used artifacts until cache fits its capacity"""
+    if not os.path.isdir(cache_dir):
+        return
+
+    # List artifacts, least recently used at first
+    entry_list = []
+    for entry_name in os.listdir(cache_dir):
+        if not entry_name.endswith(".pkl"):
+            continue
+        entry_stat = os.stat(os.path.join(cache_dir, entry_name))
+        entry_list.append((entry_stat.st_mtime_ns, entry_stat.st_size, entry_name))
+    entry_list.sort()
+
+    total_bytes = sum(entry[1] for entry in entry_list)
+    while entry_list and (total_bytes > max_bytes or len(entry_list) > max_entry):
+        _, entry_size, entry_name = entry_list.pop(0)
+        logger.debug(f"Evict stage artifact: {entry_name}")
+        os.remove(os.path.join(cache_dir, entry_name))
+        total_bytes -= entry_size
+
+
+def cached_stage(
+    stage_name: str,
+    upstream_keys: List[str],
+    params: Dict,
+    compute_func: Callable[[], Any],
+    cache_dir: str = STAGE_CACHE_DIR,
+) -> Tuple[str, Any]:
+    """Run a pipeline stage, or load its artifact if the same inputs are cached
+
+    Args:
+        stage_name (str): name of stage
+        upstream_keys (List[str]): keys of inputs, e.g. file keys or keys of upstream stages
+        params (Dict): parameters affecting output of the stage
+        compute_func (Callable[[], Any]): function to compute stage output on cache miss
+
+    Returns:
+        Tuple[str, Any]: key and output of the stage
+    """
+    key = stage_key(stage_name, upstream_keys, params)
+    artifact_filename = os.path.join(cache_dir, f"{stage_name}-{key}.pkl")
+
+    # Cache hit - refresh access time for LRU eviction, then load artifact
+    if os.path.isfile(artifact_filename):
+        logger.info(f"Stage cache hit: {stage_name} ({key[:12]})")
+        os.utime(artifact_filename)
+        with open(artifact_filename, "rb") as artifact_file:
+            return key, pickle.load(artifact_file)
+
+    # Cache miss - compute and store artifact, write to temporary file to avoid partial artifact
+    logger.info(f"Stage cache miss: {stage_name} ({key[:12]})")
+    stage_output = compute_func()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(f"{artifact_filename}.tmp", "wb") as artifact_file:
+        pickle.dump(stage_output, artifact_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(f"{artifact_filename}.tmp", artifact_filename)
+    evict(cache_dir)
+
+    return key, stage_output
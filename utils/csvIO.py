@@ -1,9 +1,319 @@
+import os
+import json
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
 import pandas as pd
+from loguru import logger
+
+# Column dtype of each raw dataset file, keyed by file name
+DATASET_SCHEMA: Dict[str, Dict[str, str]] = {
+    "sales_train.csv": {
+        "date": "object",
+        "date_block_num": "int8",
+        "shop_id": "int8",
+        "item_id": "int16",
+        "item_price": "float32",
+        "item_cnt_day": "float32",
+    },
+    "items.csv": {
+        "item_name": "object",
+        "item_id": "int16",
+        "item_category_id": "int16",
+    },
+    "test.csv": {
+        "ID": "int32",
+        "shop_id": "int8",
+        "item_id": "int16",
+    },
+}
+
+# Root directory of month-partitioned raw sales
+SALES_PARTITION_DIR = "./cache/sales_train"
+
+# Write-behind writer of output artifacts
+_background_writer: ThreadPoolExecutor = None
+_pending_write_list: List[Future] = []
 
 
 def read_csv_to_pddf(filename: str) -> pd.DataFrame:
     return pd.read_csv(filename, low_memory=False)
 
 
-def write_pd_to_csv(data: pd.DataFrame, filename: str, with_index: bool = True):
-    data.to_csv(f"./output/{filename}", index=with_index)
+def read_csv_with_schema(
+    filename: str,
+    columns: List[str] = None,
+    multithread: bool = False,
+    schema_name: str = None,
+) -> pd.DataFrame:
+    """Read raw dataset file with declared column dtype
+
+    Args:
+        filename (str): path of dataset file, its base name should be listed in DATASET_SCHEMA
+        columns (List[str], optional): columns to be loaded, load all columns in schema if None
+        multithread (bool, optional): parse file with multi-threaded pyarrow engine if available
+        schema_name (str, optional): key of DATASET_SCHEMA, use base name of filename if None
+    """
+    schema = DATASET_SCHEMA[schema_name or os.path.basename(filename)]
+
+    # Project columns to be loaded
+    if columns is None:
+        columns = list(schema.keys())
+    dtype_map = {col: schema[col] for col in columns}
+
+    # Select parser backend
+    engine = "c"
+    if multithread:
+        pandas_version = tuple(int(v) for v in pd.__version__.split(".")[:2])
+        try:
+            import pyarrow  # noqa: F401
+            if pandas_version >= (1, 4):
+                engine = "pyarrow"
+            else:
+                logger.warning("pyarrow engine requires pandas >= 1.4, fallback to single-threaded C parser")
+        except ImportError:
+            logger.warning("pyarrow is not installed, fallback to single-threaded C parser")
+
+    read_option = {}
+    if engine == "c":
+        read_option["low_memory"] = False
+
+    return pd.read_csv(
+        filename,
+        usecols=columns,
+        dtype=dtype_map,
+        engine=engine,
+        **read_option,
+    )[columns]
+
+
+def iter_csv_with_schema(
+    filename: str,
+    columns: List[str] = None,
+    chunk_size: int = 500000,
+):
+    """Iterate raw dataset file as DataFrame chunks with declared column dtype
+
+    Args:
+        filename (str): path of dataset file, its base name should be listed in DATASET_SCHEMA
+        columns (List[str], optional): columns to be loaded, load all columns in schema if None
+        chunk_size (int, optional): maximum number of rows of each chunk
+    """
+    schema = DATASET_SCHEMA[os.path.basename(filename)]
+
+    if columns is None:
+        columns = list(schema.keys())
+    dtype_map = {col: schema[col] for col in columns}
+
+    with pd.read_csv(
+        filename,
+        usecols=columns,
+        dtype=dtype_map,
+        chunksize=chunk_size,
+    ) as chunk_reader:
+        for chunk in chunk_reader:
+            yield chunk[columns]
+
+
+def _source_signature(filename: str) -> Dict[str, int]:
+    stat = os.stat(filename)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def build_sales_partition(
+    csv_filename: str,
+    partition_dir: str = SALES_PARTITION_DIR,
+    multithread: bool = True,
+):
+    """Convert raw sales file to month-partitioned columnar files
+
+    Each date_block_num is stored as a sub-directory with one .npy file per
+    numeric column, so that a reader can memory-map only the needed months.
+
+    Args:
+        csv_filename (str): path of raw sales file, e.g. ./dataset/sales_train.csv
+        partition_dir (str, optional): root directory of partitioned files
+        multithread (bool, optional): parse raw file with multi-threaded engine
+    """
+    schema = DATASET_SCHEMA[os.path.basename(csv_filename)]
+    columns = [col for col, dtype in schema.items() if dtype != "object"]
+
+    logger.info(f"Build month partition of {csv_filename} into {partition_dir}")
+    sales_data = read_csv_with_schema(csv_filename, columns, multithread)
+
+    # Re-create partition directory
+    if os.path.isdir(partition_dir):
+        shutil.rmtree(partition_dir)
+    os.makedirs(partition_dir)
+
+    # Stable sort by month keeps original record order inside each partition
+    sales_data = sales_data.sort_values("date_block_num", kind="mergesort")
+    month_np = sales_data["date_block_num"].to_numpy()
+    month_list, month_offset = np.unique(month_np, return_index=True)
+    month_bound = np.append(month_offset, len(month_np))
+
+    for it, month in enumerate(month_list):
+        month_dir = os.path.join(partition_dir, f"date_block_num={month:02d}")
+        os.makedirs(month_dir)
+        for col in columns:
+            np.save(
+                os.path.join(month_dir, f"{col}.npy"),
+                sales_data[col].to_numpy()[month_bound[it]:month_bound[it + 1]],
+            )
+
+    # Write meta data at last, a partition is valid only if meta data exists
+    partition_meta = {
+        "source": os.path.abspath(csv_filename),
+        "signature": _source_signature(csv_filename),
+        "columns": columns,
+        "dtypes": {col: schema[col] for col in columns},
+        "months": [int(month) for month in month_list],
+    }
+    with open(os.path.join(partition_dir, "partition_meta.json"), "w") as meta_file:
+        json.dump(partition_meta, meta_file, indent=2)
+
+
+def read_sales_partition(
+    partition_dir: str = SALES_PARTITION_DIR,
+    columns: List[str] = None,
+    month_range: Tuple[int, int] = None,
+) -> pd.DataFrame:
+    """Read month-partitioned sales data with column projection and month filter
+
+    Args:
+        partition_dir (str, optional): root directory of partitioned files
+        columns (List[str], optional): columns to be loaded, load all columns if None
+        month_range (Tuple[int, int], optional): inclusive range of date_block_num to be loaded
+    """
+    with open(os.path.join(partition_dir, "partition_meta.json"), "r") as meta_file:
+        partition_meta = json.load(meta_file)
+
+    if columns is None:
+        columns = partition_meta["columns"]
+
+    # Predicate pushdown - only touch partitions in month range
+    month_list = partition_meta["months"]
+    if month_range is not None:
+        month_list = [
+            month for month in month_list
+            if month_range[0] <= month <= month_range[1]
+        ]
+
+    # Memory-map column files of selected partitions, then concatenate them
+    column_np = {}
+    for col in columns:
+        if not month_list:
+            column_np[col] = np.empty(0, dtype=partition_meta["dtypes"][col])
+            continue
+
+        column_np[col] = np.concatenate(
+            [
+                np.load(
+                    os.path.join(partition_dir, f"date_block_num={month:02d}", f"{col}.npy"),
+                    mmap_mode="r",
+                )
+                for month in month_list
+            ]
+        )
+
+    return pd.DataFrame(column_np, columns=columns)
+
+
+def read_sales_train(
+    csv_filename: str,
+    columns: List[str] = None,
+    month_range: Tuple[int, int] = None,
+    partition_dir: str = SALES_PARTITION_DIR,
+) -> pd.DataFrame:
+    """Read raw sales through month partition, build partition if it is absent or stale"""
+    meta_filename = os.path.join(partition_dir, "partition_meta.json")
+
+    partition_valid = False
+    if os.path.isfile(meta_filename):
+        with open(meta_filename, "r") as meta_file:
+            partition_meta = json.load(meta_file)
+        partition_valid = (
+            partition_meta["source"] == os.path.abspath(csv_filename)
+            and partition_meta["signature"] == _source_signature(csv_filename)
+        )
+
+    if not partition_valid:
+        build_sales_partition(csv_filename, partition_dir)
+
+    return read_sales_partition(partition_dir, columns, month_range)
+
+
+def read_pickle_to_pddf(filename: str) -> pd.DataFrame:
+    return pd.read_pickle(filename)
+
+
+def _submit_write(write_func: Callable[[], None], filename: str, background: bool):
+    global _background_writer
+
+    if not background:
+        write_func()
+        return
+
+    # Serialize artifacts on a single background thread, keep write order
+    if _background_writer is None:
+        _background_writer = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="csvIO-writer",
+        )
+    logger.debug(f"Queue background write: {filename}")
+    _pending_write_list.append(_background_writer.submit(write_func))
+
+
+def flush_writer():
+    """Block until all queued background writes are finished, re-raise their error"""
+    global _pending_write_list
+
+    pending_write_list, _pending_write_list = _pending_write_list, []
+    for pending_write in pending_write_list:
+        pending_write.result()
+
+
+def write_pd_to_csv(
+    data: pd.DataFrame,
+    filename: str,
+    with_index: bool = True,
+    background: bool = False,
+    compression: str = None,
+):
+    """Write DataFrame to ./output as csv file
+
+    Args:
+        data (pd.DataFrame): data to be written, do not modify it before flush_writer if background is set
+        filename (str): output file name
+        with_index (bool, optional): write index of DataFrame
+        background (bool, optional): write on background thread, call flush_writer to wait for it
+        compression (str, optional): compression method, e.g. gzip, bz2, xz
+    """
+    _submit_write(
+        lambda: data.to_csv(
+            f"./output/{filename}",
+            index=with_index,
+            compression=compression,
+        ),
+        filename,
+        background,
+    )
+
+
+def write_pd_to_pickle(
+    data: pd.DataFrame,
+    filename: str,
+    background: bool = False,
+    compression: str = None,
+):
+    """Write DataFrame to ./output as binary pickle file, see write_pd_to_csv for arguments"""
+    _submit_write(
+        lambda: data.to_pickle(
+            f"./output/{filename}",
+            compression=compression,
+        ),
+        filename,
+        background,
+    )
@@ -1,7 +1,80 @@
+import json
 import pickle
+import hashlib
+from typing import Dict, Tuple
+
+import pandas as pd
+import xgboost as xgb
+
 
 def load(filename: str):
-    return pickle.load(open(filename, "rb"))
+    with open(filename, "rb") as model_file:
+        return pickle.load(model_file)
 
 def save(model, filename: str):
-    pickle.dump(model, open(f"./output/{filename}.model", "wb"))
+    with open(f"./output/{filename}.model", "wb") as model_file:
+        pickle.dump(model, model_file)
+
+
+def _booster_format() -> str:
+    # UBJSON is supported since XGBoost 1.6, use legacy binary format before it
+    xgb_version = tuple(int(v) for v in xgb.__version__.split(".")[:2])
+    return "ubj" if xgb_version >= (1, 6) else "bin"
+
+
+def dataframe_digest(data: pd.DataFrame) -> str:
+    """Evaluate content hash of a DataFrame, including its column names"""
+    digest = hashlib.sha1()
+    digest.update(",".join(map(str, data.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def save_booster(model, filename: str, metadata: Dict = None):
+    """Save model with XGBoost native serialization and a json metadata sidecar
+
+    Files are written to ./output/{filename}.{ubj|bin} and ./output/{filename}.meta.json
+
+    Args:
+        model (XGBRegressor or xgb.Booster): trained model
+        filename (str): file name without extension
+        metadata (Dict, optional): extra information, e.g. lag spec and training data hash
+    """
+    booster = model.get_booster() if isinstance(model, xgb.XGBModel) else model
+    booster_format = _booster_format()
+
+    model_meta = {
+        "format": booster_format,
+        "xgboost_version": xgb.__version__,
+        "feature_names": booster.feature_names,
+        "best_iteration": booster.attr("best_iteration"),
+    }
+    if metadata is not None:
+        model_meta.update(metadata)
+
+    booster.save_model(f"./output/{filename}.{booster_format}")
+    with open(f"./output/{filename}.meta.json", "w") as meta_file:
+        json.dump(model_meta, meta_file, indent=2)
+
+
+def load_booster(filename: str) -> Tuple[xgb.Booster, Dict]:
+    """Load ready-to-predict booster saved by save_booster
+
+    Args:
+        filename (str): path of model without extension, e.g. ./output/xgbr_new_feature
+
+    Returns:
+        Tuple[xgb.Booster, Dict]: booster and its metadata
+    """
+    with open(f"{filename}.meta.json", "r") as meta_file:
+        model_meta = json.load(meta_file)
+
+    with open(f"{filename}.{model_meta['format']}", "rb") as model_file:
+        booster = xgb.Booster(model_file=bytearray(model_file.read()))
+
+    # Legacy binary format does not keep feature names and attributes
+    booster.feature_names = model_meta["feature_names"]
+    if model_meta["best_iteration"] is not None:
+        booster.set_attr(best_iteration=str(model_meta["best_iteration"]))
+
+    return booster, model_meta
@@ -0,0 +1,91 @@
+# Provide partition access of a DataFrame sorted once by its partition keys
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+class PartitionIndex:
+    """Rows of a DataFrame grouped into contiguous partitions by key columns
+
+    Frame is sorted once by the key columns with a stable sort, so rows of a
+    partition keep their original order and original index. Offset table maps
+    each key tuple to its [start, end) row range, so a partition is one
+    positional slice instead of a full scan with DataFrame.query.
+    """
+
+    def __init__(
+        self,
+        input_data: pd.DataFrame,
+        keys: List[str],
+    ):
+        self.keys = list(keys)
+
+        # Step 1. Stable sort by key columns, the first key is the major key
+        key_np = [input_data[key].to_numpy() for key in self.keys]
+        order = np.lexsort(key_np[::-1]) if len(input_data) else np.zeros(0, dtype=np.int64)
+        self.sorted_data = input_data.take(order)
+
+        # Step 2. Locate boundaries of partitions
+        sorted_key_np = [key[order] for key in key_np]
+        boundary_flag = np.zeros(len(order), dtype=bool)
+        if len(order):
+            boundary_flag[0] = True
+            for key in sorted_key_np:
+                boundary_flag[1:] |= key[1:] != key[:-1]
+        start_np = np.flatnonzero(boundary_flag)
+        self.offsets = np.append(start_np, len(order))
+
+        # Step 3. Offset table keyed by key tuple
+        self.key_list = [
+            tuple(key[start].item() for key in sorted_key_np)
+            for start in start_np
+        ]
+        self.offset_dict = {
+            key_tuple: (int(start), int(end))
+            for key_tuple, start, end in zip(self.key_list, self.offsets[:-1], self.offsets[1:])
+        }
+
+    def __len__(self) -> int:
+        return len(self.key_list)
+
+    def __contains__(self, key_tuple: Tuple) -> bool:
+        return tuple(key_tuple) in self.offset_dict
+
+    def bounds(self, key_tuple: Tuple) -> Tuple[int, int]:
+        """Return [start, end) row range of a partition in sorted_data, empty range if key is absent"""
+        return self.offset_dict.get(tuple(key_tuple), (0, 0))
+
+    def get(self, key_tuple: Tuple) -> pd.DataFrame:
+        """Return rows of a partition, empty frame with same columns if key is absent
+
+        Returned frame is a positional slice of sorted_data, copy it before modification.
+        """
+        start, end = self.bounds(key_tuple)
+        return self.sorted_data.iloc[start:end]
+
+    def column(self, column: str, key_tuple: Tuple) -> np.ndarray:
+        """Return values of a column in a partition as a view of the sorted column"""
+        start, end = self.bounds(key_tuple)
+        return self.sorted_data[column].to_numpy()[start:end]
+
+    def range_slice(self, lb_key: Tuple = None, ub_key: Tuple = None) -> pd.DataFrame:
+        """Return rows of all partitions with lb_key <= key <= ub_key, as one contiguous slice
+
+        Key tuples are compared in sorting order, None means unbounded.
+        """
+        start_np = self.offsets[:-1]
+        lb_position = 0 if lb_key is None else int(np.searchsorted(
+            [key >= tuple(lb_key) for key in self.key_list], True
+        ))
+        ub_position = len(self.key_list) if ub_key is None else int(np.searchsorted(
+            [key > tuple(ub_key) for key in self.key_list], True
+        ))
+        if lb_position >= ub_position:
+            return self.sorted_data.iloc[0:0]
+        return self.sorted_data.iloc[start_np[lb_position]:self.offsets[ub_position]]
+
+    def __iter__(self) -> Iterator[Tuple[Tuple, pd.DataFrame]]:
+        """Iterate (key tuple, partition) in sorted key order"""
+        for key_tuple, start, end in zip(self.key_list, self.offsets[:-1], self.offsets[1:]):
+            yield key_tuple, self.sorted_data.iloc[start:end]
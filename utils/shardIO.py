@@ -0,0 +1,137 @@
+# Write encoded training data shard by shard and stream shards back from disk
+import os
+import json
+import shutil
+import hashlib
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+
+def _shard_digest(data: pd.DataFrame) -> str:
+    # Content hash of a shard, the same as modelIO.dataframe_digest
+    digest = hashlib.sha1()
+    digest.update(",".join(map(str, data.columns)).encode())
+    digest.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def write_shards(
+    shard_iter: Iterable[Tuple[int, pd.DataFrame]],
+    shard_dir: str,
+    shard_by: str = "date_block_num",
+    source_key: str = None,
+) -> Dict:
+    """Write each shard to disk as soon as it is produced
+
+    Each shard is stored as a sub-directory with one .npy file per column,
+    e.g. {shard_dir}/date_block_num=24/total_sales_p1.npy, so that only
+    one shard is held in memory by writer and reader.
+
+    Args:
+        shard_iter (Iterable[Tuple[int, pd.DataFrame]]): (shard key, shard data), all shards with the same columns
+        shard_dir (str): root directory of shards, re-created if exists
+        shard_by (str, optional): name of shard key, used in sub-directory name
+        source_key (str, optional): cache key of shard content, see shard_source_key
+
+    Returns:
+        Dict: meta data of written shards
+    """
+    # Re-create shard directory
+    if os.path.isdir(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir)
+
+    shard_meta = {
+        "shard_by": shard_by,
+        "source_key": source_key,
+        "columns": None,
+        "dtypes": None,
+        "shards": [],
+    }
+    for shard_key, shard_data in shard_iter:
+        if shard_meta["columns"] is None:
+            shard_meta["columns"] = [str(col) for col in shard_data.columns]
+            shard_meta["dtypes"] = {str(col): str(dtype) for col, dtype in shard_data.dtypes.items()}
+        assert list(shard_data.columns) == shard_meta["columns"], f"Inconsistant columns of shard {shard_key}"
+
+        shard_name = f"{shard_by}={int(shard_key):02d}"
+        os.makedirs(os.path.join(shard_dir, shard_name))
+        for col in shard_meta["columns"]:
+            np.save(os.path.join(shard_dir, shard_name, f"{col}.npy"), shard_data[col].to_numpy())
+
+        shard_meta["shards"].append(
+            {
+                "key": int(shard_key),
+                "name": shard_name,
+                "rows": len(shard_data),
+                "digest": _shard_digest(shard_data),
+            }
+        )
+        logger.debug(f"Write shard {shard_name}, rows: {len(shard_data)}")
+
+    # Write meta data at last, shards are valid only if meta data exists
+    with open(os.path.join(shard_dir, "shard_meta.json"), "w") as meta_file:
+        json.dump(shard_meta, meta_file, indent=2)
+
+    return shard_meta
+
+
+def shard_source_key(shard_dir: str) -> str:
+    """Return source key of complete shards in shard_dir, None if absent or incomplete"""
+    meta_filename = os.path.join(shard_dir, "shard_meta.json")
+    if not os.path.isfile(meta_filename):
+        return None
+    with open(meta_filename, "r") as meta_file:
+        return json.load(meta_file).get("source_key")
+
+
+class ShardReader:
+    """Read shards written by write_shards one at a time, columns are memory-mapped"""
+
+    def __init__(
+        self,
+        shard_dir: str,
+        columns: List[str] = None,
+    ):
+        with open(os.path.join(shard_dir, "shard_meta.json"), "r") as meta_file:
+            self.shard_meta = json.load(meta_file)
+
+        self.shard_dir = shard_dir
+        self.columns = self.shard_meta["columns"] if columns is None else list(columns)
+        self.keys = [shard["key"] for shard in self.shard_meta["shards"]]
+        self._shard_dict = {shard["key"]: shard for shard in self.shard_meta["shards"]}
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    @property
+    def row_count(self) -> int:
+        return sum([shard["rows"] for shard in self.shard_meta["shards"]])
+
+    def read(self, shard_key: int, columns: List[str] = None) -> pd.DataFrame:
+        """Read one shard, only requested columns are loaded"""
+        shard = self._shard_dict[shard_key]
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame(
+            {
+                col: np.load(os.path.join(self.shard_dir, shard["name"], f"{col}.npy"), mmap_mode="r")
+                for col in columns
+            },
+            columns=columns,
+        )
+
+    def __iter__(self) -> Iterator[Tuple[int, pd.DataFrame]]:
+        """Iterate (shard key, shard data) in written order"""
+        for shard_key in self.keys:
+            yield shard_key, self.read(shard_key)
+
+    def digest(self) -> str:
+        """Content hash of all shards, evaluated from digests in meta data"""
+        digest = hashlib.sha1()
+        for shard in self.shard_meta["shards"]:
+            digest.update(shard["digest"].encode())
+        return digest.hexdigest()